@@ -1,501 +1,3115 @@
-import requests
-import csv
-import io
-import json
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from datetime import datetime, date, timedelta
-import time
-from bs4 import BeautifulSoup
-import pytz
-import html
-import re # Para extraer año y país
-
-# --- Configuración (sin cambios) ---
-TARGET_CHANNELS = [
-    {"casid": "5252"},
-    {"casid": "4955"}
-]
-CSV_URL = "https://raw.githubusercontent.com/parotris3/Mfeed/main/difusion.csv"
-BASE_PROGRAM_URL = "https://www.movistarplus.es/programacion-tv/"
-OUTPUT_XML_FILE = "popups.xml" # Nuevo nombre de archivo
-REQUEST_DELAY = 0.5
-LOCAL_TIMEZONE = pytz.timezone('Europe/Madrid')
-
-# --- Funciones Auxiliares ---
-# Las funciones obtener_datos_canal_csv, formatear_fecha_xmltv,
-# obtener_programacion_movistar (la parte de encontrar detail_url y original_titulo),
-# y prettify_xml se mantienen como en la versión anterior.
-# Asegúrate de tener sus definiciones completas y correctas aquí.
-
-# --- COPIA AQUÍ LAS FUNCIONES COMPLETAS Y CORRECTAS ---
-# def obtener_datos_canal_csv(...) -> nombre, logo, cod_cadena_tv
-# def formatear_fecha_xmltv(...) -> str_fecha_xmltv | None
-# def obtener_programacion_movistar(...) -> lista_programas (con original_titulo, detail_url, etc.)
-# def prettify_xml(...) -> str_xml_formateado
-
-# (Incluyo las definiciones de la última versión para completitud,
-#  asegúrate de que son las que te funcionan)
-def obtener_datos_canal_csv(cas_id_buscar, url):
-    print(f"INFO: Obteniendo datos del canal con CasId {cas_id_buscar} desde {url}")
-    try:
-        response = requests.get(url, timeout=15); response.raise_for_status()
-        try: decoded_text = response.content.decode('utf-8-sig')
-        except UnicodeDecodeError: decoded_text = response.text
-        csv_file = io.StringIO(decoded_text); reader = csv.reader(csv_file, delimiter=',', quotechar='"')
-        header = next(reader)
-        try:
-            casid_index = header.index('CasId'); nombre_index = header.index('Nombre')
-            logo_index = header.index('Logo'); cod_cadena_tv_index = header.index('CodCadenaTv')
-        except ValueError as e: print(f"ERROR: Columna no encontrada: {e}"); return None, None, None
-        max_index = max(casid_index, nombre_index, logo_index, cod_cadena_tv_index)
-        for row in reader:
-            if len(row) > max_index:
-                if row[casid_index] == cas_id_buscar:
-                    nombre = row[nombre_index]; logo = row[logo_index]; cod_cadena_tv = row[cod_cadena_tv_index]
-                    if nombre and logo and cod_cadena_tv: return nombre, logo, cod_cadena_tv
-                    else: print(f"ERROR: Datos incompletos para CasId {cas_id_buscar}"); return None, None, None
-        print(f"ERROR: CasId {cas_id_buscar} no encontrado."); return None, None, None
-    except Exception as e: print(f"ERROR en CSV: {e}"); return None, None, None
-
-def formatear_fecha_xmltv(fecha_iso):
-    try:
-        if len(fecha_iso) > 6 and fecha_iso[-3] == ':': fecha_iso = fecha_iso[:-3] + fecha_iso[-2:]
-        return datetime.fromisoformat(fecha_iso).strftime("%Y%m%d%H%M%S %z")
-    except ValueError: return None
-
-def obtener_programacion_movistar(url, canal_nombre_target):
-    print(f"INFO: Obteniendo programación para '{canal_nombre_target}' desde {url}")
-    programas = []
-    try:
-        # Extraer la fecha de la URL para construir las fechas completas
-        date_match = re.search(r'/(\d{4}-\d{2}-\d{2})$', url)
-        if not date_match:
-            print(f"ERROR: No se pudo extraer la fecha de la URL: {url}")
-            return []
-        current_date_str = date_match.group(1)
-        current_date_obj = datetime.strptime(current_date_str, '%Y-%m-%d').date()
-
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'lxml')
-
-        # 1. Encontrar todos los bloques de programas por su clase 'container_box'
-        # Usamos una función lambda para que coincida aunque tenga más clases (ej. "container_box g_CN")
-        program_blocks = soup.find_all('div', class_=lambda c: c and 'container_box' in c.split())
-        
-        if not program_blocks:
-            print(f"ADVERTENCIA: No se encontró ningún bloque 'container_box' para '{canal_nombre_target}'.")
-            return []
-
-        # 2. Extraer la información "en bruto" de cada bloque
-        parsed_items = []
-        for block in program_blocks:
-            link_tag = block.find('a', href=True)
-            title_tag = block.find('li', class_='title')
-            time_tag = block.find('li', class_='time')
-
-            if link_tag and title_tag and time_tag:
-                hora_inicio_str = time_tag.get_text(strip=True)  # "05:43"
-                titulo = title_tag.get_text(strip=True)
-                detail_url = link_tag.get('href', '')
-                if detail_url.startswith('/'):
-                    detail_url = f"https://www.movistarplus.es{detail_url}"
-
-                # Construir el objeto datetime de inicio con la fecha y la zona horaria
-                try:
-                    hora, minuto = map(int, hora_inicio_str.split(':'))
-                    dt_start = LOCAL_TIMEZONE.localize(datetime.combine(current_date_obj, datetime.min.time())).replace(hour=hora, minute=minuto)
-                    
-                    # Si el programa empieza de madrugada (ej. 00:00 a 06:00), es probable que pertenezca al día siguiente 
-                    # en el contexto de la parrilla del día anterior. Hay que manejar esto si causa problemas,
-                    # pero por ahora lo dejamos así ya que la web los lista en el día correcto.
-
-                    parsed_items.append({
-                        "original_titulo": titulo,
-                        "dt_start": dt_start,
-                        "canal_nombre": canal_nombre_target,
-                        "detail_url": detail_url
-                    })
-                except ValueError:
-                    print(f"ADVERTENCIA: Formato de hora inesperado '{hora_inicio_str}' para '{titulo}'.")
-                    continue
-        
-        if not parsed_items:
-            print(f"INFO: No se encontraron items de programa parseables para '{canal_nombre_target}'.")
-            return []
-
-        # 3. Deducir la hora de fin a partir del inicio del siguiente programa
-        for i, prog in enumerate(parsed_items):
-            dt_end = None
-            if i + 1 < len(parsed_items):
-                # La hora de fin es la hora de inicio del siguiente programa
-                dt_end = parsed_items[i+1]['dt_start']
-                
-                # Comprobación por si el siguiente programa es del día siguiente (la parrilla cruza la medianoche)
-                if dt_end < prog['dt_start']:
-                    dt_end += timedelta(days=1)
-
-            else:
-                # Es el último programa listado. No podemos saber el fin. Lo omitimos para no tener datos incorrectos.
-                print(f"ADVERTENCIA: No se puede determinar la hora de fin para el último programa del día: '{prog['original_titulo']}'. Se omitirá.")
-                continue
-
-            # Formatear fechas a XMLTV
-            fecha_inicio_xmltv = prog['dt_start'].strftime("%Y%m%d%H%M%S %z")
-            fecha_fin_xmltv = dt_end.strftime("%Y%m%d%H%M%S %z")
-
-            programas.append({
-                "original_titulo": prog['original_titulo'],
-                "inicio": fecha_inicio_xmltv,
-                "fin": fecha_fin_xmltv,
-                "canal_nombre": prog['canal_nombre'],
-                "detail_url": prog['detail_url']
-            })
-
-        print(f"INFO: Programación extraída para '{canal_nombre_target}'. Total: {len(programas)}")
-        return programas
-
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR en Programación URL {url}: {e}")
-        return []
-    except Exception as e:
-        import traceback
-        print(f"ERROR inesperado procesando programación para '{canal_nombre_target}': {e}")
-        traceback.print_exc()
-        return []
-
-def prettify_xml(elem):
-    rough_string = ET.tostring(elem, 'utf-8'); reparsed = minidom.parseString(rough_string)
-    return reparsed.toprettyxml(indent="  ", encoding="UTF-8").decode('utf-8')
-
-# MODIFICADA: Función para extraer todos los detalles necesarios
-def obtener_detalles_programa(detail_url):
-    """
-    Obtiene múltiples detalles desde la URL de la ficha de un programa.
-    Devuelve un diccionario con los campos encontrados.
-    """
-    if not detail_url:
-        return {}
-    print(f"\nDEBUG: Procesando detalles completos para: {detail_url}")
-    
-    details = {
-        'og_titulo': None, 'sinopsis': None, 'icon_url': None, 'categoria': None,
-        'pais': None, 'año': None, 'calificacion': None, 'ratingValue': None,
-        'bestRating': None, 'presenta': None, 'director': None, 'reparto': None,
-        'guion': None, 'musica': None, 'produccion': None, 'productora': None
-    }
-
-    try:
-        time.sleep(REQUEST_DELAY) # Ya definido en tu script
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        response = requests.get(detail_url, headers=headers, timeout=15)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'lxml')
-
-        # --- Extracción de meta etiquetas (og:title y sinopsis de name="description") ---
-        og_title_tag = soup.find('meta', property='og:title')
-        if og_title_tag and og_title_tag.get('content'):
-            details['og_titulo'] = og_title_tag['content'].strip()
-            print(f"DEBUG: og:title = '{details['og_titulo']}'")
-
-        desc_tag = soup.find('meta', attrs={'name': 'description'})
-        if desc_tag and desc_tag.get('content'):
-            full_description = html.unescape(desc_tag['content'].strip())
-            separator = " - "
-            separator_index = full_description.find(separator)
-            if separator_index != -1:
-                details['sinopsis'] = full_description[separator_index + len(separator):].strip()
-                # print(f"DEBUG: Sinopsis (procesada) = '{details['sinopsis'][:50]}...'")
-            else:
-                details['sinopsis'] = full_description
-                # print(f"DEBUG: Sinopsis (completa) = '{details['sinopsis'][:50]}...'")
-        
-        # --- NUEVA Extracción HTML para Categoria, Pais, Año, Calificacion ---
-        # Buscar primero el <ul>. Los <p> relevantes son hermanos que le siguen.
-        ul_info_movie = soup.find('ul', class_='list-info-movie')
-        if ul_info_movie:
-            print("DEBUG: <ul class='list-info-movie'> encontrado.")
-            # El primer <p> hermano siguiente debería ser la categoría
-            p_categoria = ul_info_movie.find_next_sibling('p')
-            if p_categoria:
-                details['categoria'] = p_categoria.get_text(strip=True)
-                print(f"DEBUG: Categoria (desde p) = '{details['categoria']}'")
-                
-                # El segundo <p> hermano (hermano del p_categoria) debería ser País (Año)
-                p_pais_ano = p_categoria.find_next_sibling('p')
-                if p_pais_ano:
-                    text_p_pais_ano = p_pais_ano.get_text(strip=True)
-                    print(f"DEBUG: Pais/Año P (texto) = '{text_p_pais_ano}'")
-                    match = re.search(r'^(.*?)\s*\((\d{4})\)$', text_p_pais_ano)
-                    if match:
-                        details['pais'] = match.group(1).strip()
-                        details['año'] = match.group(2).strip()
-                        print(f"DEBUG: País = '{details['pais']}', Año = '{details['año']}'")
-                    else: # Si no hay año en paréntesis, asumir que todo es el país
-                        details['pais'] = text_p_pais_ano
-                        print(f"DEBUG: País (sin año en formato esperado) = '{details['pais']}'")
-                else:
-                    print("DEBUG: No se encontró el segundo <p> para País/Año.")
-            else:
-                print("DEBUG: No se encontró el primer <p> para Categoría.")
-        else:
-            print("ADVERTENCIA: <ul class='list-info-movie'> no encontrado.")
-
-        # Calificación (dentro de <div class="moral">)
-        moral_div = soup.find('div', class_='moral')
-        if moral_div:
-            print("DEBUG: <div class='moral'> encontrado.")
-            # No es necesario buscar el h3 Calificación si la img está directamente en moral_div
-            # y es la única o la identificable por su 'alt'.
-            # El snippet muestra solo una img, asumimos que es la de calificación.
-            img_cal = moral_div.find('img', alt=True) 
-            if img_cal and img_cal.get('alt'):
-                details['calificacion'] = img_cal['alt'].strip()
-                print(f"DEBUG: Calificación (alt de img) = '{details['calificacion']}'")
-            else:
-                print("DEBUG: No se encontró <img> con 'alt' en <div class='moral'>.")
-        else:
-            print("ADVERTENCIA: <div class='moral'> no encontrado para Calificación.")
-            
-        # --- Extracción de Presentador, Guionista (como antes, ajustar si es necesario) ---
-        presentador_h3 = soup.find('h3', class_="heading", string=re.compile(r'Presentador', re.IGNORECASE))
-        if presentador_h3:
-            p_presentador = presentador_h3.find_next_sibling('p')
-            if p_presentador: details['presenta'] = p_presentador.get_text(strip=True)
-        
-        guionista_h3 = soup.find('h3', class_="heading", string=re.compile(r'Guionista', re.IGNORECASE))
-        if guionista_h3:
-            p_guionista = guionista_h3.find_next_sibling('p')
-            if p_guionista:
-                span_guionista = p_guionista.find('span')
-                details['guion'] = span_guionista.get_text(strip=True) if span_guionista else p_guionista.get_text(strip=True)
-
-        # --- Extracción de JSON-LD (como antes para rating, director, reparto, musica, produccion, productora, icon_url) ---
-        def extract_names_from_json_list(data_list):
-            # ... (función auxiliar igual que antes) ...
-            if not data_list: return None
-            names = []
-            if not isinstance(data_list, list): data_list = [data_list]
-            for entry in data_list:
-                if isinstance(entry, dict) and 'name' in entry: names.append(entry['name'].strip())
-                elif isinstance(entry, str): names.append(entry.strip())
-            return ", ".join(names) if names else None
-
-        scripts_jsonld = soup.find_all('script', type='application/ld+json')
-        json_ld_data_found_main_block = False # Para no sobreescribir si ya encontramos un bloque principal
-        for script in scripts_jsonld:
-            try:
-                data = json.loads(script.string)
-                items_to_check = []
-                if isinstance(data, dict): items_to_check.append(data)
-                elif isinstance(data, list): items_to_check.extend(data)
-
-                for item in items_to_check:
-                    # Intentar procesar solo el bloque principal una vez para estos campos
-                    # Esto es una heurística, puede que no siempre sea el primer bloque relevante
-                    current_item_is_main_type = item.get("@type") in ["Movie", "TVEpisode", "TVSeries", "CreativeWork"]
-
-                    if not json_ld_data_found_main_block or not current_item_is_main_type:
-                        if current_item_is_main_type:
-                            json_ld_data_found_main_block = True
-
-                        if 'director' in item and not details.get('director'):
-                             details['director'] = extract_names_from_json_list(item.get('director'))
-                        if 'actor' in item and not details.get('reparto'):
-                             details['reparto'] = extract_names_from_json_list(item.get('actor'))
-                        if 'musicBy' in item and not details.get('musica'):
-                             details['musica'] = extract_names_from_json_list(item.get('musicBy'))
-                        if 'producer' in item and not details.get('produccion'):
-                             details['produccion'] = extract_names_from_json_list(item.get('producer'))
-                        if 'productionCompany' in item and not details.get('productora'):
-                             details['productora'] = extract_names_from_json_list(item.get('productionCompany'))
-                        
-                        if 'aggregateRating' in item and isinstance(item['aggregateRating'], dict):
-                            if 'ratingValue' in item['aggregateRating'] and not details.get('ratingValue'):
-                                details['ratingValue'] = str(item['aggregateRating']['ratingValue'])
-                            if 'bestRating' in item['aggregateRating'] and not details.get('bestRating'):
-                                details['bestRating'] = str(item['aggregateRating']['bestRating'])
-                        elif 'ratingValue' in item and not details.get('ratingValue'):
-                             details['ratingValue'] = str(item.get('ratingValue'))
-
-                        if 'image' in item and not details.get('icon_url'):
-                            image_data = item['image']
-                            if isinstance(image_data, str): details['icon_url'] = image_data
-                            elif isinstance(image_data, dict) and image_data.get('@type') == 'ImageObject' and 'url' in image_data:
-                                details['icon_url'] = image_data['url']
-                            elif isinstance(image_data, list) and image_data:
-                                first_image = image_data[0]
-                                if isinstance(first_image, str): details['icon_url'] = first_image
-                                elif isinstance(first_image, dict) and first_image.get('@type') == 'ImageObject' and 'url' in first_image:
-                                    details['icon_url'] = first_image['url']
-            except (json.JSONDecodeError, AttributeError):
-                continue
-        # --- Fin Extracción JSON-LD ---
-
-        # Imprimir un resumen de lo encontrado para depuración final de esta función
-        print(f"DEBUG FINAL detalles: Cat='{details.get('categoria')}', Pais='{details.get('pais')}', Año='{details.get('año')}', Calif='{details.get('calificacion')}'")
-        # print(f"DEBUG FINAL detalles: Sinopsis='{str(details.get('sinopsis'))[:30]}...', Rating='{details.get('ratingValue')}/{details.get('bestRating')}', Director='{details.get('director')}', Icono='{details.get('icon_url') is not None}'")
-
-        return details
-
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR: No se pudo obtener la página de detalle {detail_url}: {e}")
-        return details # Devuelve lo que se haya podido recoger hasta el momento
-    except Exception as e:
-        print(f"ERROR: Error inesperado al procesar la página de detalle {detail_url}: {e}")
-        return details
-
-
-# --- Script Principal ---
-if __name__ == "__main__":
-    print("--- Iniciando generación de EPG XML con descripciones completas (3 días) ---")
-    print(f"ADVERTENCIA: Este proceso será MUY largo debido al scraping detallado.")
-    start_time_global = time.time()
-
-    channels_data = {}
-    all_programs_processed = {}
-
-    today = datetime.now(LOCAL_TIMEZONE).date()
-    dates_to_process = [today + timedelta(days=i) for i in range(3)]
-    date_strings = [d.strftime('%Y-%m-%d') for d in dates_to_process]
-    print(f"INFO: Se procesarán las fechas: {', '.join(date_strings)}")
-
-    for target in TARGET_CHANNELS:
-        cas_id = target["casid"]
-        print(f"\n--- Procesando Canal con CasId: {cas_id} ---")
-        nombre_canal, logo_canal, cod_cadena_tv = obtener_datos_canal_csv(cas_id, CSV_URL)
-
-        if not nombre_canal or not logo_canal or not cod_cadena_tv:
-            print(f"ADVERTENCIA: Datos CSV incompletos para CasId {cas_id}. Saltando.")
-            continue
-        channels_data[nombre_canal] = {"logo": logo_canal, "casid": cas_id}
-        programas_combinados_canal = []
-
-        for date_str in date_strings:
-            program_url = f"{BASE_PROGRAM_URL}{cod_cadena_tv}/{date_str}"
-            print(f"INFO: Obteniendo lista de programas desde: {program_url} (Fecha: {date_str})")
-            lista_programas_dia = obtener_programacion_movistar(program_url, nombre_canal)
-            if lista_programas_dia:
-                programas_combinados_canal.extend(lista_programas_dia)
-            else:
-                print(f"ADVERTENCIA: No se encontró programación para '{nombre_canal}' en {date_str}.")
-        
-        all_programs_processed[nombre_canal] = programas_combinados_canal
-        print(f"INFO: Total programas acumulados para '{nombre_canal}' (3 días): {len(programas_combinados_canal)}")
-
-    print("\n--- Obteniendo detalles completos para todos los programas (puede tardar HORAS) ---")
-    total_programas_a_detallar = sum(len(progs) for progs in all_programs_processed.values())
-    prog_count = 0
-    if total_programas_a_detallar == 0:
-         print("INFO: No hay programas para obtener detalles.")
-    else:
-        print(f"INFO: Se intentarán obtener detalles para {total_programas_a_detallar} programas...")
-        for nombre_canal, lista_programas in all_programs_processed.items():
-            if not lista_programas: continue
-            for programa in lista_programas:
-                prog_count += 1
-                prog_title_orig = programa.get('original_titulo', 'Desconocido')
-                print(f"\rINFO: Prog {prog_count}/{total_programas_a_detallar} ('{prog_title_orig[:35]}...')", end="")
-                
-                # Inicializar campos de detalle en el programa por si falla la obtención
-                detalle_fields = ['og_titulo', 'sinopsis', 'icon_url', 'categoria', 'pais', 'año', 
-                                  'calificacion', 'ratingValue', 'bestRating', 'presenta', 'director', 
-                                  'reparto', 'guion', 'musica', 'produccion', 'productora']
-                for field in detalle_fields:
-                    programa[field] = None
-
-                if programa.get("detail_url"):
-                    # Aquí se actualiza el diccionario 'programa' directamente con los detalles
-                    # devueltos por obtener_detalles_programa
-                    fetched_details = obtener_detalles_programa(programa["detail_url"])
-                    if fetched_details: # Si devuelve un diccionario (incluso con Nones)
-                        programa.update(fetched_details)
-                else:
-                    print(" -> Sin URL detalle", end=" ") # Añadir espacio para que no se solape con el siguiente \r
-
-        print("\nINFO: Obtención de detalles finalizada.")
-
-    print("\n--- Generando archivo XML combinado (3 días) con descripciones completas ---")
-    fecha_actual = datetime.now().strftime("%d/%m/%Y %H:%M")
-    root = ET.Element("tv", attrib={"generator-info-name": f"MultiPopUps FullDesc {fecha_actual}"})
-
-    for nombre_canal, data in channels_data.items():
-        channel_elem = ET.SubElement(root, "channel", attrib={"id": nombre_canal})
-        ET.SubElement(channel_elem, "display-name").text = nombre_canal
-        ET.SubElement(channel_elem, "icon", attrib={"src": data["logo"]})
-    print(f"INFO: Añadidos {len(channels_data)} canales al XML.")
-
-    programas_agregados_xml = 0
-    for nombre_canal, lista_programas in all_programs_processed.items():
-        if nombre_canal in channels_data:
-            print(f"INFO: Añadiendo {len(lista_programas)} programas para '{nombre_canal}'...")
-            for prog_data in lista_programas:
-                if not prog_data.get("inicio") or not prog_data.get("fin"):
-                    print(f"ADVERTENCIA: Programa '{prog_data.get('original_titulo')}' omitido por falta de hora de inicio/fin.")
-                    continue
-
-                programme_elem = ET.SubElement(root, "programme", attrib={
-                    "start": prog_data["inicio"], "stop": prog_data["fin"], "channel": nombre_canal
-                })
-                
-                final_title = prog_data.get("og_titulo") or prog_data.get("original_titulo") or "Título no disponible"
-                ET.SubElement(programme_elem, "title", attrib={"lang": "es"}).text = final_title
-
-                # --- Construcción del <desc> ---
-                desc_parts = []
-                # Linea 1: %categoria% | %año% | %calificacion% | *%ratingValue%/%bestRating%
-                line1_elements = []
-                if prog_data.get('categoria'): line1_elements.append(prog_data['categoria'])
-                #if prog_data.get('año'): line1_elements.append(prog_data['año'])
-                if prog_data.get('calificacion'): line1_elements.append(prog_data['calificacion'])
-                
-                rating_val = prog_data.get('ratingValue')
-                best_rat = prog_data.get('bestRating')
-                if rating_val and best_rat: line1_elements.append(f"*{rating_val}/{best_rat}")
-                elif rating_val: line1_elements.append(f"*{rating_val}") # Si solo hay ratingValue
-
-                if line1_elements: desc_parts.append(" | ".join(line1_elements))
-
-                # Sinopsis
-                if prog_data.get('sinopsis'): desc_parts.append(f"· {prog_data['sinopsis']}")
-                
-                # Campos adicionales con etiqueta
-                def add_labeled_part(label, key):
-                    value = prog_data.get(key)
-                    if value: desc_parts.append(f"· {label}: {value}")
-                
-                add_labeled_part("País", 'pais')
-                add_labeled_part("Presenta", 'presenta')
-                add_labeled_part("Director", 'director')
-                add_labeled_part("Reparto", 'reparto')
-                add_labeled_part("Guion", 'guion')
-                add_labeled_part("Música", 'musica')
-                add_labeled_part("Producción", 'produccion')
-                add_labeled_part("Productora", 'productora')
-
-                final_desc_text = "\n".join(desc_parts) if desc_parts else "(Información detallada no disponible)"
-                ET.SubElement(programme_elem, "desc", attrib={"lang": "es"}).text = final_desc_text
-                # --- Fin Construcción del <desc> ---
-
-                icon_url = prog_data.get("icon_url")
-                if icon_url:
-                    ET.SubElement(programme_elem, "icon", attrib={"src": icon_url})
-                
-                programas_agregados_xml += 1
-
-    print(f"INFO: Total de {programas_agregados_xml} programas añadidos al XML.")
-
-    try:
-        xml_str_formatted = prettify_xml(root)
-        with open(OUTPUT_XML_FILE, "w", encoding="UTF-8") as f: f.write(xml_str_formatted)
-        print(f"INFO: Archivo XML generado exitosamente: '{OUTPUT_XML_FILE}'")
-    except Exception as e:
-        print(f"ERROR: No se pudo escribir el archivo XML: {e}")
-
-    end_time_global = time.time()
-    print(f"--- Proceso finalizado en {end_time_global - start_time_global:.2f} segundos ---")
-
-
-
+import argparse
+import bisect
+import contextlib
+import functools
+import logging
+import sys
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import unquote, urlsplit
+import csv
+import hashlib
+import heapq
+import itertools
+import io
+import os
+import json
+import multiprocessing
+import gzip
+from datetime import datetime, date, timedelta, timezone
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+import threading
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
+import pytz
+import html
+import random
+import re # Para extraer año y país
+import sqlite3
+import tempfile
+import unicodedata
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    from PIL import Image # Opcional: solo lo usan las miniaturas de la etapa de imágenes
+except ImportError:
+    Image = None
+
+# --- Configuración (sin cambios) ---
+TARGET_CHANNELS = [ # Canales por defecto; se pueden sustituir con --canales o --canales-file
+    {"casid": "5252"},
+    {"casid": "4955"}
+]
+DIAS_A_PROCESAR = 3
+GRID_WORKERS = 8 # Hilos para descargar parrillas (canal, día) en paralelo
+PARRILLAS_POR_ADELANTADO = GRID_WORKERS * 2 # Parrillas que se descargan por delante de la etapa de detalles
+PIPELINE_PROFUNDIDAD = 64 # Programas en vuelo (con su ficha descargándose) antes de escribirse en el XML
+PRESUPUESTO_SEGUNDOS = None # Tiempo máximo de la ejecución; al agotarse se escribe la guía con las fichas obtenidas (--presupuesto)
+FICHAS_RECORDADAS = 20000 # Fichas resueltas que se recuerdan en memoria para no repetir URLs en la misma ejecución
+CSV_URL = "https://raw.githubusercontent.com/parotris3/Mfeed/main/difusion.csv"
+BASE_PROGRAM_URL = "https://www.movistarplus.es/programacion-tv/"
+OUTPUT_XML_FILE = "popups.xml" # Nuevo nombre de archivo
+SALIDA_GZIP = False # Escribe además OUTPUT_XML_FILE + ".gz" (se puede activar con --gzip)
+PETICIONES_POR_SEGUNDO = 4.0 # Límite global de descargas de fichas (compartido por todos los hilos)
+RAFAGA_PETICIONES = 4 # Peticiones que se pueden lanzar seguidas antes de que actúe el límite
+DETALLES_WORKERS = 8 # Hilos que descargan fichas en paralelo
+HTTP_POOL_HOSTS = 4 # Hosts distintos con conexiones keep-alive abiertas a la vez
+HTTP_POOL_POR_HOST = GRID_WORKERS + DETALLES_WORKERS # Conexiones reutilizables por host: parrillas y fichas van a la vez al mismo host (una por hilo)
+HTTP_REINTENTOS = 3 # Reintentos ante 429/5xx o fallos de conexión
+HTTP_BACKOFF = 1.0 # Espera base (s) entre reintentos: 1, 2, 4...
+CACHE_RESPUESTAS_FILE = "respuestas_cache.sqlite" # Parrillas y CSV guardados para revalidar con 304 (None para desactivar)
+MODO_INCREMENTAL = True # Reutiliza los detalles de la ejecución anterior para las franjas que no han cambiado
+ESTADO_FILE = "popups_estado.sqlite" # Estado por canal y día que usa el modo incremental
+PARSEO_PROCESOS = 0 # Procesos que extraen fichas y parrillas en paralelo (--procesos); 0: en los hilos de descarga
+PARSEO_LOTE = 16 # Páginas que se envían juntas a cada proceso, para que el paso de datos no se coma la ganancia
+MOTOR_PARSEO = "lxml" # "lxml" (XPath precompiladas, rápido) o "bs4" (BeautifulSoup, el original)
+LOCAL_TIMEZONE = pytz.timezone('Europe/Madrid')
+CACHE_DETALLES_FILE = "detalles_cache.sqlite" # Caché persistente de fichas (None para desactivar)
+CACHE_TTL_SEGUNDOS = 7 * 24 * 3600 # Antigüedad máxima de una ficha cacheada antes de volver a descargarla
+CACHE_MAX_ENTRADAS = 20000 # Al superarlo se descartan las fichas usadas hace más tiempo (LRU)
+NIVEL_LOG = "INFO" # DEBUG, INFO, ADVERTENCIA o ERROR (se puede cambiar con --nivel-log)
+IMAGENES = False # Etapa opcional: descarga las carátulas, genera miniaturas y reescribe los <icon src> (--imagenes)
+IMAGENES_DIR = "iconos" # Caché en disco de las carátulas originales y sus miniaturas
+IMAGENES_URL_BASE = "iconos/" # Prefijo de los <icon src> reescritos: ruta relativa o URL de la CDN que publica IMAGENES_DIR
+MINIATURAS_ANCHOS = (180,) # Anchos (px) de las miniaturas; los <icon src> apuntan a la primera
+IMAGENES_WORKERS = 4 # Hilos que descargan carátulas (y otros tantos que generan miniaturas)
+IMAGENES_MAX_MB = 500 # Tamaño máximo de IMAGENES_DIR; al superarlo se borran las carátulas usadas hace más tiempo
+VENTANA_FUSION = 1000 # Programas por guía que `fusionar` puede retener para reordenar entradas casi ordenadas
+INDICE_GUIA = True # Genera junto al XML un índice SQLite para consultas rápidas (popups.idx.sqlite); no se versiona: si falta, se reconstruye del XML al cargar
+SERVIR_HOST = "0.0.0.0" # Dirección en la que escucha el modo servir
+SERVIR_PUERTO = 8080 # Puerto del modo servir
+SERVIR_INTERVALO_MINUTOS = 360 # Cada cuánto se regenera la guía en el modo servir
+DELTA_FILE = None # Cambios por canal y día respecto a la guía anterior, en JSON (--delta)
+INFORME_FILE = None # Informe de la ejecución: .json, o .prom para el textfile collector de Prometheus (--informe)
+VARIANTES_BENCH = { # Variantes que compara el subcomando bench: nombre -> constantes que cambia
+    "base": {},
+    "bs4": {"MOTOR_PARSEO": "bs4"},
+    "fichas 1 hilo": {"DETALLES_WORKERS": 1},
+    "gzip": {"SALIDA_GZIP": True},
+    "procesos": {"PARSEO_PROCESOS": os.cpu_count() or 1},
+}
+PAGINAS_BENCH_PARSEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "fixtures", "html") # Parrillas y fichas de ejemplo que usa bench-parseo si no se le dan rutas
+
+# --- Funciones Auxiliares ---
+# Las funciones obtener_datos_canal_csv, formatear_fecha_xmltv,
+# obtener_programacion_movistar (la parte de encontrar detail_url y original_titulo),
+# se mantienen como en la versión anterior.
+# Asegúrate de tener sus definiciones completas y correctas aquí.
+
+# --- COPIA AQUÍ LAS FUNCIONES COMPLETAS Y CORRECTAS ---
+# def obtener_datos_canal_csv(...) -> nombre, logo, cod_cadena_tv
+# def formatear_fecha_xmltv(...) -> str_fecha_xmltv | None
+# def obtener_programacion_movistar(...) -> lista_programas (con original_titulo, detail_url, etc.)
+
+# --- Registro y métricas ---
+logging.addLevelName(logging.WARNING, "ADVERTENCIA")
+log = logging.getLogger("epg-popups")
+
+def configurar_log(nivel=NIVEL_LOG):
+    """Mensajes a stdout con el formato de siempre ("INFO: ...") a partir de `nivel`."""
+    manejador = logging.StreamHandler(sys.stdout)
+    manejador.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    log.handlers[:] = [manejador]
+    log.propagate = False
+    log.setLevel(nivel.upper())
+
+@contextlib.contextmanager
+def log_silenciado(nivel=logging.ERROR):
+    """Sube temporalmente el nivel del registro, para medir tiempos sin la salida de depuración."""
+    anterior = log.level
+    log.setLevel(max(nivel, anterior))
+    try:
+        yield
+    finally:
+        log.setLevel(anterior)
+
+class Metricas:
+    """
+    Temporizadores y contadores de la ejecución, seguros entre hilos. Cada etapa acumula
+    llamadas, segundos y el máximo de una llamada (las etapas que corren en varios hilos
+    pueden sumar más que el tiempo real). Las latencias HTTP se guardan en histogramas
+    por grupo de URL (host y primer tramo de la ruta).
+    """
+    LIMITES_LATENCIA = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.etapas = {}
+        self.contadores = {}
+        self.latencias = {}
+
+    def reiniciar(self):
+        with self._lock:
+            self.etapas, self.contadores, self.latencias = {}, {}, {}
+
+    @contextlib.contextmanager
+    def etapa(self, nombre):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.anotar_etapa(nombre, time.perf_counter() - inicio)
+
+    def cronometrar(self, nombre):
+        """Decorador: cuenta cada llamada a la función como una ejecución de la etapa `nombre`."""
+        def decorador(funcion):
+            @functools.wraps(funcion)
+            def envoltura(*args, **kwargs):
+                with self.etapa(nombre):
+                    return funcion(*args, **kwargs)
+            return envoltura
+        return decorador
+
+    def anotar_etapa(self, nombre, segundos):
+        with self._lock:
+            e = self.etapas.setdefault(nombre, {"llamadas": 0, "segundos": 0.0, "max": 0.0})
+            e["llamadas"] += 1
+            e["segundos"] += segundos
+            e["max"] = max(e["max"], segundos)
+
+    def contar(self, nombre, n=1):
+        with self._lock:
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + n
+
+    def observar_latencia(self, url, segundos):
+        partes = urlsplit(url)
+        grupo = partes.netloc + "/" + partes.path.strip("/").split("/")[0]
+        with self._lock:
+            h = self.latencias.setdefault(grupo, {"cubetas": [0] * (len(self.LIMITES_LATENCIA) + 1), "suma": 0.0, "total": 0})
+            h["cubetas"][bisect.bisect_left(self.LIMITES_LATENCIA, segundos)] += 1
+            h["suma"] += segundos
+            h["total"] += 1
+
+    def informe(self, **extra):
+        """Diccionario con todas las métricas (más los bloques de `extra`), listo para JSON."""
+        with self._lock:
+            datos = {
+                "etapas": {nombre: dict(e) for nombre, e in self.etapas.items()},
+                "contadores": dict(self.contadores),
+                "latencias_http": {grupo: {"limites": list(self.LIMITES_LATENCIA), **{k: (list(v) if k == "cubetas" else v) for k, v in h.items()}}
+                                   for grupo, h in self.latencias.items()},
+            }
+        datos.update(extra)
+        return datos
+
+    def imprimir_etapas(self):
+        for nombre, e in sorted(self.etapas.items(), key=lambda par: -par[1]["segundos"]):
+            log.info(f"Etapa {nombre}: {e['llamadas']} llamadas, {e['segundos']:.2f} s (máx. {e['max'] * 1000:.0f} ms)")
+
+metricas = Metricas()
+
+def _informe_prometheus(datos):
+    """Texto en formato de exposición de Prometheus (para el textfile collector de node_exporter)."""
+    def etiquetas(**kv):
+        return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in kv.items()) + "}"
+    lineas = [
+        "# TYPE epg_duracion_segundos gauge", f"epg_duracion_segundos {datos['duracion_segundos']:.3f}",
+        "# TYPE epg_fin_timestamp_segundos gauge", f"epg_fin_timestamp_segundos {datos['fin']:.0f}",
+    ]
+    for metrica, campo in (("epg_etapa_llamadas_total", "llamadas"), ("epg_etapa_segundos_total", "segundos"),
+                           ("epg_etapa_max_segundos", "max")):
+        lineas.append(f"# TYPE {metrica} {'gauge' if campo == 'max' else 'counter'}")
+        lineas += [f"{metrica}{etiquetas(etapa=nombre)} {e[campo]:g}" for nombre, e in datos["etapas"].items()]
+    lineas.append("# TYPE epg_eventos_total counter")
+    lineas += [f"epg_eventos_total{etiquetas(evento=nombre)} {n}" for nombre, n in datos["contadores"].items()]
+    for campo in ("peticiones", "bytes", "304", "reintentos", "errores"):
+        metrica = f"epg_http_{'no_modificadas' if campo == '304' else campo}_total"
+        lineas.append(f"# TYPE {metrica} counter")
+        lineas += [f"{metrica}{etiquetas(host=host)} {c[campo]}" for host, c in datos.get("http", {}).items()]
+    lineas.append("# TYPE epg_http_latencia_segundos histogram")
+    for grupo, h in datos["latencias_http"].items():
+        acumulado = 0
+        for limite, n in zip(h["limites"] + ["+Inf"], h["cubetas"]):
+            acumulado += n
+            lineas.append(f"epg_http_latencia_segundos_bucket{etiquetas(grupo=grupo, le=limite)} {acumulado}")
+        lineas.append(f"epg_http_latencia_segundos_sum{etiquetas(grupo=grupo)} {h['suma']:.6f}")
+        lineas.append(f"epg_http_latencia_segundos_count{etiquetas(grupo=grupo)} {h['total']}")
+    return "\n".join(lineas) + "\n"
+
+def escribir_informe(ruta, datos):
+    """Escribe el informe en JSON o, si `ruta` acaba en .prom, en formato Prometheus (reemplazo atómico)."""
+    texto = _informe_prometheus(datos) if ruta.endswith(".prom") else json.dumps(datos, ensure_ascii=False, indent=2) + "\n"
+    temporal = ruta + ".tmp"
+    with open(temporal, "w", encoding="UTF-8") as f:
+        f.write(texto)
+    os.replace(temporal, ruta)
+    log.info(f"Informe de la ejecución escrito en '{ruta}'.")
+
+# (Incluyo las definiciones de la última versión para completitud,
+#  asegúrate de que son las que te funcionan)
+class IndiceCanales:
+    """
+    Índice en memoria de difusion.csv: el CSV se descarga (o revalida) y se parsea una sola vez
+    por ejecución, y cada canal se resuelve en tiempo constante por CasId, CodCadenaTv o Nombre.
+    Cada fila se guarda como (casid, nombre, logo, cod_cadena_tv).
+    """
+    def __init__(self, filas=(), error=None):
+        self.error = error
+        self.por_casid, self.por_cod_cadena_tv, self.por_nombre = {}, {}, {}
+        for fila in filas:
+            # Como en la búsqueda lineal original, ante duplicados vale la primera fila
+            self.por_casid.setdefault(fila[0], fila)
+            self.por_nombre.setdefault(fila[1], fila)
+            self.por_cod_cadena_tv.setdefault(fila[3], fila)
+
+    @classmethod
+    def cargar(cls, url):
+        log.info(f"Cargando índice de canales desde {url}")
+        try:
+            response = cliente_http.get_revalidado(url, timeout=15)
+            try: decoded_text = response.content.decode('utf-8-sig')
+            except UnicodeDecodeError: decoded_text = response.text
+            csv_file = io.StringIO(decoded_text); reader = csv.reader(csv_file, delimiter=',', quotechar='"')
+            header = next(reader)
+            try:
+                casid_index = header.index('CasId'); nombre_index = header.index('Nombre')
+                logo_index = header.index('Logo'); cod_cadena_tv_index = header.index('CodCadenaTv')
+            except ValueError as e: log.error(f"Columna no encontrada: {e}"); return cls(error=e)
+            max_index = max(casid_index, nombre_index, logo_index, cod_cadena_tv_index)
+            indice = cls((row[casid_index], row[nombre_index], row[logo_index], row[cod_cadena_tv_index])
+                         for row in reader if len(row) > max_index)
+            log.info(f"Índice de canales: {len(indice.por_casid)} CasIds.")
+            return indice
+        except Exception as e: log.error(f"No se pudo cargar el CSV: {e}"); return cls(error=e)
+
+    def buscar(self, clave):
+        """Fila del canal cuyo CasId, CodCadenaTv o Nombre (por ese orden) es `clave`, o None."""
+        return self.por_casid.get(clave) or self.por_cod_cadena_tv.get(clave) or self.por_nombre.get(clave)
+
+_indices_canales = {}
+_lock_indices_canales = threading.Lock()
+
+def indice_canales(url=CSV_URL):
+    """Devuelve el IndiceCanales de `url`, cargándolo la primera vez (los demás hilos esperan a esa carga)."""
+    with _lock_indices_canales:
+        if url not in _indices_canales:
+            with metricas.etapa("csv"):
+                _indices_canales[url] = IndiceCanales.cargar(url)
+        return _indices_canales[url]
+
+def obtener_datos_canal_csv(cas_id_buscar, url):
+    log.info(f"Resolviendo canal {cas_id_buscar}")
+    indice = indice_canales(url)
+    if indice.error is not None:
+        return None, None, None
+    fila = indice.buscar(cas_id_buscar)
+    if fila is None:
+        log.error(f"CasId {cas_id_buscar} no encontrado."); return None, None, None
+    _, nombre, logo, cod_cadena_tv = fila
+    if nombre and logo and cod_cadena_tv: return nombre, logo, cod_cadena_tv
+    else: log.error(f"Datos incompletos para CasId {cas_id_buscar}"); return None, None, None
+
+class LimitadorTasa:
+    """
+    Token bucket compartido entre hilos: permite como máximo `tasa` peticiones por segundo,
+    con ráfagas de hasta `rafaga` peticiones. Sustituye a la pausa fija antes de cada petición.
+    """
+    def __init__(self, tasa, rafaga=1):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self._tokens = float(rafaga)
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        with self._lock:
+            ahora = time.monotonic()
+            self._tokens = min(self.rafaga, self._tokens + (ahora - self._ultimo) * self.tasa)
+            self._ultimo = ahora
+            # Se reserva el token aunque aún no exista; cada hilo espera su turno fuera del lock
+            self._tokens -= 1
+            espera = -self._tokens / self.tasa if self._tokens < 0 else 0
+        if espera > 0:
+            time.sleep(espera)
+
+limitador_peticiones = LimitadorTasa(PETICIONES_POR_SEGUNDO, RAFAGA_PETICIONES)
+
+
+class RespuestaHTTP:
+    """Cuerpo ya descargado de una respuesta (o recuperado del almacén tras un 304)."""
+    def __init__(self, content, encoding, revalidada=False):
+        self.content = content
+        self.encoding = encoding
+        self.revalidada = revalidada
+
+    @property
+    def text(self):
+        return str(self.content, self.encoding or 'utf-8', errors='replace')
+
+
+class AlmacenRespuestas:
+    """
+    Guarda en SQLite el cuerpo y los validadores (ETag / Last-Modified) de las parrillas y del CSV
+    para poder reutilizarlos cuando el servidor contesta 304 Not Modified.
+    """
+    def __init__(self, ruta):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(ruta, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS respuestas (
+            url TEXT PRIMARY KEY, contenido BLOB NOT NULL, encoding TEXT,
+            etag TEXT, last_modified TEXT, descargado REAL NOT NULL)""")
+        self.conn.commit()
+
+    def obtener(self, url):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT contenido, encoding, etag, last_modified FROM respuestas WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        return {"contenido": row[0], "encoding": row[1], "etag": row[2], "last_modified": row[3]}
+
+    def guardar(self, url, contenido, encoding, etag, last_modified):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO respuestas (url, contenido, encoding, etag, last_modified, descargado) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, contenido, encoding, etag, last_modified, time.time()))
+            self.conn.commit()
+
+    def cerrar(self):
+        with self._lock:
+            self.conn.close()
+
+
+class ClienteHTTP:
+    """
+    Capa HTTP compartida por todo el script: una única Session con conexiones keep-alive
+    reutilizables, reintentos con backoff ante 429/5xx y peticiones condicionales
+    (If-None-Match / If-Modified-Since). Lleva la cuenta, por host, de peticiones, bytes
+    transferidos, respuestas 304, reintentos y handshakes TCP+TLS ahorrados.
+    Con `grabador` guarda cada respuesta descargada y con `replay_base` envía todas las
+    peticiones a un ServidorReplay local en lugar de a los servidores reales.
+    """
+    def __init__(self, pool_hosts=HTTP_POOL_HOSTS, pool_por_host=HTTP_POOL_POR_HOST,
+                 reintentos=HTTP_REINTENTOS, backoff=HTTP_BACKOFF):
+        retry = Retry(total=reintentos, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET']), raise_on_status=False)
+        self._adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_por_host, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        self.almacen = None
+        self.grabador = None
+        self.replay_base = None
+        self._contadores = {}
+        self._lock = threading.Lock()
+
+    def abrir_almacen(self, ruta):
+        self.almacen = AlmacenRespuestas(ruta)
+
+    def get(self, url, headers=None, timeout=15, etag=None, last_modified=None):
+        """GET a través de la Session compartida. Con `etag`/`last_modified` la petición es condicional."""
+        headers = dict(headers or {})
+        if self.grabador is None: # Al grabar hace falta el cuerpo completo de todas las respuestas
+            if etag: headers['If-None-Match'] = etag
+            if last_modified: headers['If-Modified-Since'] = last_modified
+        inicio = time.perf_counter()
+        try:
+            response = self.session.get(self._destino(url), headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException:
+            self._contar_error(url)
+            raise
+        metricas.observar_latencia(url, time.perf_counter() - inicio)
+        self._contar(url, response)
+        if self.grabador is not None and response.status_code == 200:
+            self.grabador.guardar(url, response)
+        return response
+
+    def _destino(self, url):
+        """URL a la que se pide realmente `url`: la misma, o su ruta en el ServidorReplay."""
+        if self.replay_base is None:
+            return url
+        partes = urlsplit(url)
+        return f"{self.replay_base}/{partes.scheme}/{partes.netloc}{partes.path}" + (f"?{partes.query}" if partes.query else "")
+
+    def get_revalidado(self, url, headers=None, timeout=15):
+        """
+        GET condicional contra la copia del almacén: si el servidor responde 304 se devuelve
+        el cuerpo guardado sin volver a descargarlo. Lanza RequestException si la respuesta es un error.
+        """
+        guardada = self.almacen.obtener(url) if self.almacen else None
+        response = self.get(url, headers, timeout,
+                            guardada and guardada["etag"], guardada and guardada["last_modified"])
+        if response.status_code == 304 and guardada is not None:
+            return RespuestaHTTP(guardada["contenido"], guardada["encoding"], revalidada=True)
+        response.raise_for_status()
+        encoding = response.encoding or response.apparent_encoding
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        if self.almacen and (etag or last_modified):
+            self.almacen.guardar(url, response.content, encoding, etag, last_modified)
+        return RespuestaHTTP(response.content, encoding)
+
+    def _contar(self, url, response):
+        host = urlsplit(url).netloc
+        transferidos = len(response.content)
+        try:
+            transferidos = response.raw.tell() or transferidos # Bytes en el cable (comprimidos)
+        except Exception:
+            pass
+        retries = getattr(response.raw, 'retries', None)
+        with self._lock:
+            c = self._contadores_host(host)
+            c["peticiones"] += 1
+            c["bytes"] += transferidos
+            c["304"] += response.status_code == 304
+            c["reintentos"] += len(retries.history) if retries else 0
+            c["errores"] += response.status_code >= 400
+
+    def _contar_error(self, url):
+        """Petición que no llegó a tener respuesta (conexión, timeout o reintentos agotados)."""
+        with self._lock:
+            c = self._contadores_host(urlsplit(url).netloc)
+            c["peticiones"] += 1
+            c["errores"] += 1
+
+    def _contadores_host(self, host):
+        return self._contadores.setdefault(host, {"peticiones": 0, "bytes": 0, "304": 0, "reintentos": 0, "errores": 0})
+
+    def estadisticas(self):
+        """Contadores por host, incluyendo conexiones abiertas y handshakes ahorrados por keep-alive."""
+        conexiones = {}
+        for pool_key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(pool_key)
+            if pool is None:
+                continue
+            c = conexiones.setdefault(pool.host, {"conexiones": 0, "peticiones_pool": 0})
+            c["conexiones"] += pool.num_connections
+            c["peticiones_pool"] += pool.num_requests
+        with self._lock:
+            resultado = {host: dict(c) for host, c in self._contadores.items()}
+        for host, c in resultado.items():
+            pool = conexiones.get(urlsplit(f"//{host}").hostname, {"conexiones": 0, "peticiones_pool": 0})
+            c["conexiones"] = pool["conexiones"]
+            c["handshakes_ahorrados"] = max(pool["peticiones_pool"] - pool["conexiones"], 0)
+        return resultado
+
+    def reiniciar_estadisticas(self):
+        with self._lock:
+            self._contadores = {}
+
+    def imprimir_estadisticas(self):
+        for host, c in self.estadisticas().items():
+            log.info(f"HTTP {host}: {c['peticiones']} peticiones, {c['bytes'] / 1024:.1f} KiB, "
+                     f"{c['304']} sin cambios (304), {c['reintentos']} reintentos, {c['errores']} errores, "
+                     f"{c['conexiones']} conexiones, {c['handshakes_ahorrados']} handshakes ahorrados")
+
+    def cerrar(self):
+        self.session.close()
+        if self.almacen:
+            self.almacen.cerrar()
+        if self.grabador:
+            self.grabador.cerrar()
+
+cliente_http = ClienteHTTP()
+
+
+# --- Grabación y reproducción ---
+class GrabadorRespuestas:
+    """
+    Guarda en `directorio` el cuerpo de cada respuesta 200 (CSV, parrillas y fichas) con un
+    index.json que relaciona cada URL con su fichero y sus cabeceras, más los `metadatos` de la
+    ejecución (fechas y canales) para poder repetirla después con ServidorReplay.
+    """
+    def __init__(self, directorio, **metadatos):
+        os.makedirs(directorio, exist_ok=True)
+        self.directorio = directorio
+        self.metadatos = metadatos
+        self.respuestas = {}
+        self._lock = threading.Lock()
+
+    def guardar(self, url, response):
+        fichero = hashlib.sha1(url.encode("utf-8")).hexdigest()[:20] + ".bin"
+        with open(os.path.join(self.directorio, fichero), "wb") as f:
+            f.write(response.content)
+        with self._lock:
+            self.respuestas[url] = {"fichero": fichero, "content_type": response.headers.get("Content-Type"),
+                                    "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+
+    def cerrar(self):
+        with open(os.path.join(self.directorio, "index.json"), "w", encoding="UTF-8") as f:
+            json.dump({"metadatos": self.metadatos, "respuestas": self.respuestas}, f, ensure_ascii=False, indent=2)
+        log.info(f"Grabadas {len(self.respuestas)} respuestas en '{self.directorio}'.")
+
+class ServidorReplay:
+    """
+    Servidor HTTP local que sustituye a movistarplus.es y al CSV de canales sirviendo una
+    grabación de GrabadorRespuestas. ClienteHTTP (con `replay_base`) le pide cada URL como
+    /<esquema>/<host>/<ruta>. Añade `latencia` segundos a cada respuesta y devuelve 503 en
+    una proporción `tasa_errores` de las peticiones; responde 304 a las peticiones condicionales.
+    Se usa como contexto: arranca al entrar y se detiene al salir.
+    """
+    def __init__(self, directorio, latencia=0.0, tasa_errores=0.0, semilla=0, puerto=0):
+        with open(os.path.join(directorio, "index.json"), encoding="UTF-8") as f:
+            indice = json.load(f)
+        self.directorio = os.path.abspath(directorio)
+        self.metadatos = indice.get("metadatos", {})
+        self.respuestas = indice["respuestas"]
+        self.latencia = latencia
+        self.tasa_errores = tasa_errores
+        self._azar = random.Random(semilla)
+        self._cuerpos = {}
+        self._lock = threading.Lock()
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, como el servidor real
+            disable_nagle_algorithm = True # Cabeceras y cuerpo van por separado: sin esto cada respuesta espera el ACK retardado
+            def do_GET(self):
+                servidor._responder(self)
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", puerto), Manejador)
+        self.httpd.daemon_threads = True
+        self.url_base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._hilo = None
+
+    def _cuerpo(self, fichero):
+        with self._lock:
+            if fichero not in self._cuerpos:
+                with open(os.path.join(self.directorio, fichero), "rb") as f:
+                    self._cuerpos[fichero] = f.read()
+            return self._cuerpos[fichero]
+
+    def _responder(self, peticion):
+        esquema, _, resto = peticion.path.lstrip("/").partition("/")
+        entrada = self.respuestas.get(f"{esquema}://{resto}")
+        if self.latencia:
+            time.sleep(self.latencia)
+        with self._lock:
+            fallo = self._azar.random() < self.tasa_errores
+        if fallo or entrada is None:
+            peticion.send_response(503 if fallo else 404)
+            peticion.send_header("Content-Length", "0")
+            peticion.end_headers()
+            return
+        if entrada["etag"] and peticion.headers.get("If-None-Match") == entrada["etag"]:
+            peticion.send_response(304)
+            peticion.send_header("ETag", entrada["etag"])
+            peticion.end_headers()
+            return
+        cuerpo = self._cuerpo(entrada["fichero"])
+        peticion.send_response(200)
+        for cabecera, clave in (("Content-Type", "content_type"), ("ETag", "etag"), ("Last-Modified", "last_modified")):
+            if entrada[clave]:
+                peticion.send_header(cabecera, entrada[clave])
+        peticion.send_header("Content-Length", str(len(cuerpo)))
+        peticion.end_headers()
+        peticion.wfile.write(cuerpo)
+
+    def __enter__(self):
+        self._hilo = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._hilo.start()
+        log.info(f"Servidor de replay en {self.url_base} ({len(self.respuestas)} respuestas, "
+                 f"latencia {self.latencia * 1000:.0f} ms, {self.tasa_errores:.0%} errores).")
+        return self
+
+    def __exit__(self, tipo_exc, exc, tb):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# --- Modelo de datos ---
+DETALLE_FIELDS = ['og_titulo', 'sinopsis', 'icon_url', 'categoria', 'pais', 'año',
+                  'calificacion', 'ratingValue', 'bestRating', 'presenta', 'director',
+                  'reparto', 'guion', 'musica', 'produccion', 'productora']
+CAMPOS_INTERNADOS = frozenset({'categoria', 'pais', 'año', 'calificacion', 'ratingValue', 'bestRating', 'productora'}) # Valores muy repetidos
+
+@dataclass(slots=True)
+class DetallesPrograma:
+    """
+    Campos de la ficha de un programa. Un mismo objeto se comparte entre todas las emisiones
+    de la misma ficha y no se modifica después de crearlo; por eso puede recordar su <desc>.
+    """
+    og_titulo: str | None = None
+    sinopsis: str | None = None
+    icon_url: str | None = None
+    categoria: str | None = None
+    pais: str | None = None
+    año: str | None = None
+    calificacion: str | None = None
+    ratingValue: str | None = None
+    bestRating: str | None = None
+    presenta: str | None = None
+    director: str | None = None
+    reparto: str | None = None
+    guion: str | None = None
+    musica: str | None = None
+    produccion: str | None = None
+    productora: str | None = None
+    _descripcion: str | None = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def desde_dict(cls, datos):
+        """Crea los detalles a partir de un diccionario (ficha extraída, caché o estado incremental)."""
+        valores = {}
+        for campo in DETALLE_FIELDS:
+            valor = datos.get(campo)
+            if campo in CAMPOS_INTERNADOS and isinstance(valor, str):
+                valor = sys.intern(valor)
+            valores[campo] = valor
+        return cls(**valores)
+
+    def como_dict(self):
+        return {campo: getattr(self, campo) for campo in DETALLE_FIELDS}
+
+@dataclass(slots=True)
+class Programa:
+    """Una emisión de la parrilla; `detalles` es None mientras no se conoce su ficha."""
+    original_titulo: str
+    inicio: str | None
+    fin: str | None
+    canal_nombre: str
+    detail_url: str | None
+    detalles: DetallesPrograma | None = None
+
+    @classmethod
+    def desde_dict(cls, datos):
+        """Inverso de como_dict (las franjas sin ningún detalle quedan con detalles=None)."""
+        detalles = None
+        if any(datos.get(campo) is not None for campo in DETALLE_FIELDS):
+            detalles = DetallesPrograma.desde_dict(datos)
+        return cls(datos.get("original_titulo"), datos.get("inicio"), datos.get("fin"),
+                   datos.get("canal_nombre"), datos.get("detail_url"), detalles)
+
+    def como_dict(self):
+        """Diccionario plano con los campos de la franja y los de la ficha (formato del estado incremental)."""
+        datos = {"original_titulo": self.original_titulo, "inicio": self.inicio, "fin": self.fin,
+                 "canal_nombre": self.canal_nombre, "detail_url": self.detail_url}
+        datos.update(self.detalles.como_dict() if self.detalles is not None else dict.fromkeys(DETALLE_FIELDS))
+        return datos
+
+def formatear_fecha_xmltv(fecha_iso):
+    try:
+        if len(fecha_iso) > 6 and fecha_iso[-3] == ':': fecha_iso = fecha_iso[:-3] + fecha_iso[-2:]
+        return datetime.fromisoformat(fecha_iso).strftime("%Y%m%d%H%M%S %z")
+    except ValueError: return None
+
+def obtener_programacion_movistar(url, canal_nombre_target, parseador=None):
+    log.info(f"Obteniendo programación para '{canal_nombre_target}' desde {url}")
+    programas = []
+    try:
+        # Extraer la fecha de la URL para construir las fechas completas
+        date_match = re.search(r'/(\d{4}-\d{2}-\d{2})$', url)
+        if not date_match:
+            log.error(f"No se pudo extraer la fecha de la URL: {url}")
+            return []
+        current_date_str = date_match.group(1)
+        current_date_obj = datetime.strptime(current_date_str, '%Y-%m-%d').date()
+
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        limitador_peticiones.esperar()
+        response = cliente_http.get_revalidado(url, headers=headers, timeout=15)
+
+        # 1 y 2. Bloques 'container_box' y su información "en bruto" (hora, título, enlace)
+        if parseador is not None:
+            codificacion = response.encoding or getattr(response, "apparent_encoding", None)
+            items_brutos = parseador.extraer("parrilla", response.content, codificacion).result()
+        else:
+            items_brutos = extraer_parrilla(response.text)
+        if items_brutos is None:
+            log.warning(f"No se encontró ningún bloque 'container_box' para '{canal_nombre_target}'.")
+            return []
+
+        parsed_items = []
+        for hora_inicio_str, titulo, detail_url in items_brutos:
+            if detail_url.startswith('/'):
+                detail_url = f"https://www.movistarplus.es{detail_url}"
+
+            # Construir el objeto datetime de inicio con la fecha y la zona horaria
+            try:
+                hora, minuto = map(int, hora_inicio_str.split(':'))
+                dt_start = LOCAL_TIMEZONE.localize(datetime.combine(current_date_obj, datetime.min.time())).replace(hour=hora, minute=minuto)
+                
+                # Si el programa empieza de madrugada (ej. 00:00 a 06:00), es probable que pertenezca al día siguiente 
+                # en el contexto de la parrilla del día anterior. Hay que manejar esto si causa problemas,
+                # pero por ahora lo dejamos así ya que la web los lista en el día correcto.
+
+                parsed_items.append({
+                    "original_titulo": sys.intern(titulo),
+                    "dt_start": dt_start,
+                    "canal_nombre": canal_nombre_target,
+                    "detail_url": detail_url
+                })
+            except ValueError:
+                log.warning(f"Formato de hora inesperado '{hora_inicio_str}' para '{titulo}'.")
+                continue
+        
+        if not parsed_items:
+            log.info(f"No se encontraron items de programa parseables para '{canal_nombre_target}'.")
+            return []
+
+        # 3. Deducir la hora de fin a partir del inicio del siguiente programa
+        # (cada inicio se formatea una vez; el fin de un programa es el mismo texto que el inicio del siguiente)
+        inicios_xmltv = [prog['dt_start'].strftime("%Y%m%d%H%M%S %z") for prog in parsed_items]
+        for i, prog in enumerate(parsed_items):
+            dt_end = None
+            if i + 1 < len(parsed_items):
+                # La hora de fin es la hora de inicio del siguiente programa
+                dt_end = parsed_items[i+1]['dt_start']
+                
+                # Comprobación por si el siguiente programa es del día siguiente (la parrilla cruza la medianoche)
+                if dt_end < prog['dt_start']:
+                    dt_end += timedelta(days=1)
+
+            else:
+                # Es el último programa listado. No podemos saber el fin. Lo omitimos para no tener datos incorrectos.
+                log.warning(f"No se puede determinar la hora de fin para el último programa del día: '{prog['original_titulo']}'. Se omitirá.")
+                continue
+
+            # Formatear fechas a XMLTV
+            fecha_inicio_xmltv = inicios_xmltv[i]
+            if dt_end == parsed_items[i+1]['dt_start']:
+                fecha_fin_xmltv = inicios_xmltv[i+1]
+            else:
+                fecha_fin_xmltv = dt_end.strftime("%Y%m%d%H%M%S %z")
+
+            programas.append(Programa(prog['original_titulo'], fecha_inicio_xmltv, fecha_fin_xmltv,
+                                      prog['canal_nombre'], prog['detail_url']))
+
+        log.info(f"Programación extraída para '{canal_nombre_target}'. Total: {len(programas)}")
+        return programas
+
+    except requests.exceptions.RequestException as e:
+        log.error(f"No se pudo obtener la programación {url}: {e}")
+        return []
+    except Exception as e:
+        import traceback
+        log.error(f"Error inesperado procesando programación para '{canal_nombre_target}': {e}")
+        traceback.print_exc()
+        return []
+
+# --- Escritura XMLTV ---
+_RE_CARACTERES_NO_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def _escapar_xml(texto):
+    # Mismo escapado que minidom.toprettyxml (también en el texto se escapan las comillas)
+    return _RE_CARACTERES_NO_XML.sub('', texto).replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def _escapar_texto_xml(texto):
+    # Al re-parsear con minidom los saltos de línea \r\n y \r del texto se normalizaban a \n
+    return _escapar_xml(texto.replace("\r\n", "\n").replace("\r", "\n"))
+
+class EscritorXMLTV:
+    """
+    Escribe el XMLTV en streaming: cada <channel> y <programme> se vuelca al fichero en cuanto se
+    genera, sin construir el árbol completo en memoria. La sangría y el escapado son los mismos
+    que producía ET.tostring + minidom.toprettyxml, así que la salida es idéntica byte a byte.
+    Acepta varias rutas a la vez; las que terminan en .gz se comprimen con gzip. Cada fichero se
+    escribe primero en un temporal y solo sustituye al anterior si todo ha ido bien y su contenido
+    ha cambiado: la huella (sha256) no incluye la cabecera, donde el generador lleva la fecha.
+    """
+    def __init__(self, rutas, generador):
+        self.rutas = [rutas] if isinstance(rutas, str) else list(rutas)
+        self.generador = generador
+        self.canales = 0
+        self.programas = 0
+        self.sin_cambios = False
+        self._huella = hashlib.sha256()
+        self._ficheros = []
+        self._raiz_abierta = False
+
+    def __enter__(self):
+        for ruta in self.rutas:
+            temporal = ruta + ".tmp"
+            crudo = None
+            if ruta.endswith(".gz"):
+                # mtime=0 para que el .gz solo cambie cuando cambia su contenido
+                crudo = open(temporal, "wb")
+                binario = gzip.GzipFile(filename=os.path.basename(ruta)[:-3], mode="wb", mtime=0, fileobj=crudo)
+                fichero = io.TextIOWrapper(binario, encoding="UTF-8")
+            else:
+                fichero = open(temporal, "w", encoding="UTF-8")
+            self._ficheros.append((ruta, temporal, fichero, crudo))
+        self._escribir(f'<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="{_escapar_xml(self.generador)}"')
+        return self
+
+    def __exit__(self, tipo_exc, exc, tb):
+        if tipo_exc is None:
+            self._escribir("</tv>\n" if self._raiz_abierta else "/>\n")
+        sin_cambios = tipo_exc is None
+        for ruta, temporal, fichero, crudo in self._ficheros:
+            fichero.close()
+            if crudo is not None: # GzipFile no cierra el fichero que recibe en fileobj
+                crudo.close()
+            if tipo_exc is None and not self._igual_que(ruta):
+                os.replace(temporal, ruta)
+                sin_cambios = False
+            else:
+                os.remove(temporal)
+        self.sin_cambios = sin_cambios
+        return False
+
+    @property
+    def huella(self):
+        return self._huella.hexdigest()
+
+    def _igual_que(self, ruta):
+        try:
+            return os.path.exists(ruta) and huella_xmltv(ruta) == self.huella
+        except (OSError, EOFError):
+            return False
+
+    def _escribir(self, texto):
+        if self._raiz_abierta:
+            self._huella.update(texto.encode("utf-8"))
+        for _, _, fichero, _ in self._ficheros:
+            fichero.write(texto)
+
+    def _abrir_raiz(self):
+        if not self._raiz_abierta:
+            self._escribir(">\n")
+            self._raiz_abierta = True
+
+    @staticmethod
+    def _elemento(etiqueta, atributos, texto=None, sangria="    "):
+        attrs = "".join(f' {k}="{_escapar_xml(v)}"' for k, v in atributos.items())
+        if texto:
+            return f"{sangria}<{etiqueta}{attrs}>{_escapar_texto_xml(texto)}</{etiqueta}>\n"
+        return f"{sangria}<{etiqueta}{attrs}/>\n"
+
+    def canal(self, channel_id, display_name, icon_src):
+        self._abrir_raiz()
+        self._escribir(f'  <channel id="{_escapar_xml(channel_id)}">\n'
+                       + self._elemento("display-name", {}, display_name)
+                       + self._elemento("icon", {"src": icon_src})
+                       + "  </channel>\n")
+        self.canales += 1
+
+    def volcar(self, xml, programa=True):
+        """Escribe tal cual un <programme> (o un <channel>) ya serializado, como los que copia fusionar_xmltv."""
+        self._abrir_raiz()
+        self._escribir(f"  {xml}\n")
+        if programa:
+            self.programas += 1
+        else:
+            self.canales += 1
+
+    def programa(self, start, stop, channel, title, desc, icon_src=None):
+        self._abrir_raiz()
+        partes = [f'  <programme start="{_escapar_xml(start)}" stop="{_escapar_xml(stop)}" channel="{_escapar_xml(channel)}">\n',
+                  self._elemento("title", {"lang": "es"}, title),
+                  self._elemento("desc", {"lang": "es"}, desc)]
+        if icon_src:
+            partes.append(self._elemento("icon", {"src": icon_src}))
+        partes.append("  </programme>\n")
+        self._escribir("".join(partes))
+        self.programas += 1
+
+
+# --- Índice de consulta de la guía ---
+def ruta_indice_guia(ruta_xml):
+    """Ruta del índice SQLite que acompaña a un XMLTV: popups.xml -> popups.idx.sqlite."""
+    if ruta_xml.endswith(".gz"):
+        ruta_xml = ruta_xml[:-3]
+    return os.path.splitext(ruta_xml)[0] + ".idx.sqlite"
+
+def instante_xmltv(fecha_xmltv):
+    """Segundos epoch de una fecha XMLTV ("20240101060000 +0100"; sin segundos o sin zona, que se toma como UTC)."""
+    # A mano en vez de con strptime, que era lo más lento de fusionar guías grandes
+    cifras, _, zona = fecha_xmltv.strip().partition(" ")
+    c = cifras[:14].ljust(14, "0")
+    instante = int(datetime(int(c[:4]), int(c[4:6]), int(c[6:8]), int(c[8:10]), int(c[10:12]), int(c[12:14]),
+                            tzinfo=timezone.utc).timestamp())
+    if zona:
+        if len(zona) != 5 or zona[0] not in "+-":
+            raise ValueError(f"zona horaria no válida en la fecha XMLTV '{fecha_xmltv}'")
+        desfase = int(zona[1:3]) * 3600 + int(zona[3:5]) * 60
+        instante -= desfase if zona[0] == "+" else -desfase
+    return instante
+
+def abrir_xmltv(ruta):
+    """Abre en binario un XMLTV, comprimido con gzip si termina en .gz."""
+    return gzip.open(ruta, "rb") if ruta.endswith(".gz") else open(ruta, "rb")
+
+def normalizar_titulo(titulo):
+    """Clave de búsqueda por título: minúsculas y sin tildes."""
+    descompuesto = unicodedata.normalize("NFKD", titulo.casefold())
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+class EscritorIndiceGuia:
+    """
+    Escribe el índice SQLite de la guía a la vez que el XML (canales y, por programa, canal,
+    inicio, fin y título). Como EscritorXMLTV, trabaja sobre un temporal que solo sustituye al
+    índice anterior si todo ha ido bien.
+    """
+    LOTE = 1000
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.temporal = ruta + ".tmp"
+        self._pendientes = []
+        self.conn = None
+
+    def __enter__(self):
+        if os.path.exists(self.temporal):
+            os.remove(self.temporal)
+        self.conn = sqlite3.connect(self.temporal)
+        self.conn.executescript("""
+            CREATE TABLE canales (id TEXT PRIMARY KEY, nombre TEXT, icono TEXT);
+            CREATE TABLE programas (canal TEXT NOT NULL, inicio INTEGER NOT NULL, fin INTEGER NOT NULL,
+                                    titulo TEXT, titulo_normalizado TEXT);""")
+        return self
+
+    def __exit__(self, tipo_exc, exc, tb):
+        try:
+            if tipo_exc is None:
+                self._volcar()
+                self.conn.executescript("""
+                    CREATE INDEX programas_canal_inicio ON programas (canal, inicio);
+                    CREATE INDEX programas_titulo ON programas (titulo_normalizado);""")
+                self.conn.commit()
+        finally:
+            self.conn.close()
+        if tipo_exc is None:
+            os.replace(self.temporal, self.ruta)
+        else:
+            os.remove(self.temporal)
+        return False
+
+    def canal(self, channel_id, display_name, icon_src):
+        self.conn.execute("INSERT OR REPLACE INTO canales VALUES (?, ?, ?)", (channel_id, display_name, icon_src))
+
+    def programa(self, start, stop, channel, title):
+        self._pendientes.append((channel, instante_xmltv(start), instante_xmltv(stop), title, normalizar_titulo(title)))
+        if len(self._pendientes) >= self.LOTE:
+            self._volcar()
+
+    def _volcar(self):
+        self.conn.executemany("INSERT INTO programas VALUES (?, ?, ?, ?, ?)", self._pendientes)
+        self._pendientes = []
+
+class IndiceGuia:
+    """
+    Índice en memoria de una guía ya generada, para responder sin volver a parsear el XML qué
+    se emite ahora / a continuación en un canal, qué hay en un intervalo y qué programas tienen
+    un título. Por canal guarda arrays de inicios y fines (epoch) ordenados por inicio, el máximo
+    acumulado de los fines (los programas de un canal pueden solaparse, así que los fines no
+    están ordenados) y una lista ordenada con el título normalizado a partir de cada una de sus
+    palabras; todas las consultas son bisect, O(log n) más los solapes que haya.
+    Se carga del índice SQLite que acompaña al XML o, si falta o es más antiguo, del propio XMLTV.
+    """
+    def __init__(self):
+        self.nombres = {} # id de canal -> display-name
+        self._inicios = {}
+        self._fines = {}
+        self._fines_max = {} # canal -> máximo de los fines hasta cada posición (no decreciente)
+        self._titulos = {}
+        self._por_titulo = [] # (título normalizado desde una de sus palabras, canal, posición)
+
+    @classmethod
+    def cargar(cls, ruta_xml=OUTPUT_XML_FILE):
+        ruta_indice = ruta_indice_guia(ruta_xml)
+        if os.path.exists(ruta_indice) and (not os.path.exists(ruta_xml)
+                                            or os.path.getmtime(ruta_indice) >= os.path.getmtime(ruta_xml)):
+            return cls.desde_sqlite(ruta_indice)
+        return cls.desde_xmltv(ruta_xml)
+
+    @classmethod
+    def desde_sqlite(cls, ruta):
+        indice = cls()
+        conn = sqlite3.connect(f"file:{ruta}?mode=ro", uri=True)
+        try:
+            indice.nombres = dict(conn.execute("SELECT id, nombre FROM canales"))
+            for canal, inicio, fin, titulo in conn.execute("SELECT canal, inicio, fin, titulo FROM programas ORDER BY canal, inicio"):
+                indice._agregar(canal, inicio, fin, titulo)
+        finally:
+            conn.close()
+        return indice._terminar()
+
+    @classmethod
+    def desde_xmltv(cls, ruta):
+        """Una sola pasada con iterparse, liberando cada elemento tras leerlo."""
+        indice = cls()
+        programas = []
+        with abrir_xmltv(ruta) as f:
+            for _, elem in etree.iterparse(f, events=("end",), tag=("channel", "programme")):
+                if elem.tag == "channel":
+                    indice.nombres[elem.get("id")] = elem.findtext("display-name")
+                else:
+                    programas.append((elem.get("channel"), instante_xmltv(elem.get("start")),
+                                      instante_xmltv(elem.get("stop")), elem.findtext("title") or ""))
+                elem.clear()
+        for programa in sorted(programas, key=lambda p: (p[0], p[1])):
+            indice._agregar(*programa)
+        return indice._terminar()
+
+    def _agregar(self, canal, inicio, fin, titulo):
+        if canal not in self._inicios:
+            self._inicios[canal], self._fines[canal], self._titulos[canal] = array("q"), array("q"), []
+        self._inicios[canal].append(inicio)
+        self._fines[canal].append(fin)
+        self._titulos[canal].append(titulo)
+
+    def _terminar(self):
+        self._fines_max = {canal: array("q", itertools.accumulate(fines, max)) for canal, fines in self._fines.items()}
+        por_titulo = []
+        for canal, titulos in self._titulos.items():
+            for i, titulo in enumerate(titulos):
+                normalizado = normalizar_titulo(titulo)
+                por_titulo += [(normalizado[m.start():], canal, i) for m in re.finditer(r"\w+", normalizado)]
+        por_titulo.sort()
+        self._por_titulo = por_titulo
+        return self
+
+    @property
+    def canales(self):
+        return list(self._inicios)
+
+    def _programa(self, canal, i):
+        zona = LOCAL_TIMEZONE
+        return {"canal": canal, "titulo": self._titulos[canal][i],
+                "inicio": datetime.fromtimestamp(self._inicios[canal][i], zona).isoformat(),
+                "fin": datetime.fromtimestamp(self._fines[canal][i], zona).isoformat()}
+
+    def ahora_y_siguiente(self, canal, instante):
+        """(programa en emisión en `instante` o None, el siguiente o None) del canal."""
+        inicios = self._inicios.get(canal)
+        if inicios is None:
+            return None, None
+        i = bisect.bisect_right(inicios, instante)
+        en_emision = self._en_emision(canal, i, instante)
+        actual = self._programa(canal, en_emision[0]) if en_emision else None
+        siguiente = self._programa(canal, i) if i < len(inicios) else None
+        return actual, siguiente
+
+    def _en_emision(self, canal, i, instante):
+        """Posiciones anteriores a `i` que siguen en emisión en `instante`, de la que empezó más tarde a la primera."""
+        fines, fines_max = self._fines[canal], self._fines_max[canal]
+        posiciones = []
+        j = i - 1
+        while j >= 0 and fines_max[j] > instante:
+            if fines[j] > instante:
+                posiciones.append(j)
+            j -= 1
+        return posiciones
+
+    def proximo_cambio(self, canal, instante):
+        """Epoch en que cambia el resultado de ahora_y_siguiente(canal, ...), o None si ya no cambia."""
+        inicios = self._inicios.get(canal)
+        if inicios is None:
+            return None
+        i = bisect.bisect_right(inicios, instante)
+        candidatos = [inicios[i]] if i < len(inicios) else []
+        candidatos += [self._fines[canal][j] for j in self._en_emision(canal, i, instante)]
+        return min(candidatos) if candidatos else None
+
+    def en_rango(self, canal, desde, hasta):
+        """Programas del canal que se solapan con [desde, hasta), por orden de inicio."""
+        inicios = self._inicios.get(canal)
+        if inicios is None:
+            return []
+        fines = self._fines[canal]
+        primero = bisect.bisect_right(self._fines_max[canal], desde)
+        ultimo = bisect.bisect_left(inicios, hasta)
+        return [self._programa(canal, i) for i in range(primero, ultimo) if fines[i] > desde]
+
+    def buscar_titulo(self, texto, canal=None, limite=50):
+        """
+        Programas con alguna palabra del título que empieza por `texto` (sin distinguir
+        mayúsculas ni tildes; `texto` puede abarcar varias palabras).
+        """
+        clave = normalizar_titulo(texto).strip()
+        resultados, vistos = [], set()
+        for i in range(bisect.bisect_left(self._por_titulo, (clave,)), len(self._por_titulo)):
+            titulo, canal_programa, posicion = self._por_titulo[i]
+            if not titulo.startswith(clave) or len(resultados) >= limite:
+                break
+            if (canal is None or canal_programa == canal) and (canal_programa, posicion) not in vistos:
+                vistos.add((canal_programa, posicion))
+                resultados.append(self._programa(canal_programa, posicion))
+        return resultados
+
+# --- Huella de la guía y cambios entre ejecuciones ---
+def huella_xmltv(ruta):
+    """sha256 de un XMLTV escrito por EscritorXMLTV sin su cabecera (la línea <tv ...> lleva la fecha)."""
+    huella = hashlib.sha256()
+    with abrir_xmltv(ruta) as f:
+        for linea in f:
+            if linea.startswith(b"<tv"):
+                break
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            huella.update(bloque)
+    return huella.hexdigest()
+
+def iterar_franjas_xmltv(ruta):
+    """Produce ((canal, "AAAA-MM-DD"), xml) por cada <programme> de un XMLTV, agrupables por canal y día de inicio."""
+    with abrir_xmltv(ruta) as f:
+        for _, elem in etree.iterparse(f, events=("end",), tag="programme"):
+            inicio = elem.get("start") or ""
+            yield (elem.get("channel") or "", f"{inicio[:4]}-{inicio[4:6]}-{inicio[6:8]}"), \
+                etree.tostring(elem, encoding="unicode", with_tail=False)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+def huellas_franjas(ruta):
+    """Huella (sha256) de los programas de cada (canal, día) de un XMLTV; {} si no existe o no se puede leer."""
+    huellas = {}
+    try:
+        for franja, xml in iterar_franjas_xmltv(ruta):
+            huellas.setdefault(franja, hashlib.sha256()).update(xml.encode("utf-8"))
+    except (OSError, EOFError, etree.XMLSyntaxError) as e:
+        if not isinstance(e, FileNotFoundError):
+            log.warning(f"No se pudo leer la guía anterior '{ruta}' para calcular los cambios: {e}")
+        return {}
+    return {franja: huella.hexdigest() for franja, huella in huellas.items()}
+
+def escribir_delta(ruta_delta, ruta_xml, anteriores, huella_anterior, huella_actual):
+    """
+    Escribe en `ruta_delta` (JSON) qué franjas (canal y día) de `ruta_xml` han cambiado respecto a
+    las huellas `anteriores`, con los <programme> completos de las nuevas o modificadas. Solo sirve
+    a quien tenga la guía con huella "anterior"; si no, tiene que descargar la guía entera.
+    Devuelve None o, si no se ha podido escribir, el motivo.
+    """
+    actuales = huellas_franjas(ruta_xml)
+    cambiadas = {franja for franja, huella in actuales.items() if anteriores.get(franja) != huella}
+    programas = {}
+    for franja, xml in iterar_franjas_xmltv(ruta_xml):
+        if franja in cambiadas:
+            programas.setdefault(franja, []).append(xml)
+    franjas = [{"canal": canal, "dia": dia, "cambio": "modificada" if (canal, dia) in anteriores else "nueva",
+                "huella": actuales[(canal, dia)], "programas": programas[(canal, dia)]}
+               for canal, dia in sorted(cambiadas)]
+    franjas += [{"canal": canal, "dia": dia, "cambio": "eliminada"} for canal, dia in sorted(set(anteriores) - set(actuales))]
+    temporal = ruta_delta + ".tmp"
+    try:
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump({"anterior": huella_anterior, "actual": huella_actual, "franjas": franjas}, f, ensure_ascii=False, indent=1)
+            f.write("\n")
+        os.replace(temporal, ruta_delta)
+    except OSError as e:
+        error = f"No se pudieron escribir los cambios en '{ruta_delta}': {e}"
+        log.error(error)
+        return error
+    log.info(f"Cambios respecto a la guía anterior en '{ruta_delta}': "
+             f"{sum(f['cambio'] != 'eliminada' for f in franjas)} franjas nuevas o modificadas, "
+             f"{sum(f['cambio'] == 'eliminada' for f in franjas)} eliminadas.")
+
+class CacheDetalles:
+    """
+    Caché persistente en SQLite de los detalles ya extraídos, indexada por detail_url.
+    Guarda el diccionario de detalles junto con la hora de descarga y los validadores HTTP
+    (ETag / Last-Modified). Las entradas caducan tras `ttl` segundos y, si se supera
+    `max_entradas`, se descartan las usadas hace más tiempo.
+    Se puede usar desde varios hilos a la vez.
+    """
+    COMMIT_CADA = 50 # Escrituras acumuladas antes de hacer commit
+
+    def __init__(self, ruta, ttl=CACHE_TTL_SEGUNDOS, max_entradas=CACHE_MAX_ENTRADAS):
+        self.ruta = ruta
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.aciertos = 0
+        self.revalidadas = 0
+        self.fallos = 0
+        self._pendientes = 0
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(ruta, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS detalles (
+            url TEXT PRIMARY KEY, detalles TEXT NOT NULL, descargado REAL NOT NULL,
+            accedido REAL NOT NULL, etag TEXT, last_modified TEXT)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_detalles_accedido ON detalles (accedido)")
+        self.conn.commit()
+
+    def obtener(self, url):
+        """Devuelve la entrada cacheada de `url` (dict) o None si no existe."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT detalles, descargado, etag, last_modified FROM detalles WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE detalles SET accedido = ? WHERE url = ?", (time.time(), url))
+            self._contar_escritura()
+        return {"detalles": json.loads(row[0]), "descargado": row[1], "etag": row[2], "last_modified": row[3]}
+
+    def es_fresca(self, entrada):
+        return time.time() - entrada["descargado"] < self.ttl
+
+    def obtener_fresca(self, url):
+        """
+        Devuelve (detalles, entrada): los detalles si la copia cacheada no ha caducado y, si ha
+        caducado, la entrada completa para revalidarla con sus validadores HTTP.
+        """
+        entrada = self.obtener(url)
+        with self._lock:
+            if entrada is not None and self.es_fresca(entrada):
+                self.aciertos += 1
+                return entrada["detalles"], entrada
+            self.fallos += 1
+        return None, entrada
+
+    def marcar_revalidada(self, url, etag=None, last_modified=None):
+        """El servidor confirmó (304) que la ficha no ha cambiado: se renueva su fecha de descarga."""
+        with self._lock:
+            self.revalidadas += 1
+            self.conn.execute(
+                "UPDATE detalles SET descargado = ?, etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) WHERE url = ?",
+                (time.time(), etag, last_modified, url))
+            self._contar_escritura()
+
+    def guardar(self, url, detalles, etag=None, last_modified=None):
+        ahora = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO detalles (url, detalles, descargado, accedido, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, json.dumps(detalles, ensure_ascii=False), ahora, ahora, etag, last_modified))
+            self._contar_escritura()
+
+    def podar(self):
+        """Elimina las entradas menos usadas recientemente hasta respetar `max_entradas`."""
+        with self._lock:
+            total = self.conn.execute("SELECT COUNT(*) FROM detalles").fetchone()[0]
+            sobrantes = total - self.max_entradas
+            if sobrantes > 0:
+                self.conn.execute(
+                    "DELETE FROM detalles WHERE url IN (SELECT url FROM detalles ORDER BY accedido LIMIT ?)", (sobrantes,))
+                log.info(f"Caché de detalles: {sobrantes} entradas descartadas (LRU).")
+        return max(sobrantes, 0)
+
+    def cerrar(self):
+        self.podar()
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def _contar_escritura(self):
+        self._pendientes += 1
+        if self._pendientes >= self.COMMIT_CADA:
+            self.conn.commit()
+            self._pendientes = 0
+
+
+# --- Motores de extracción ---
+# Las funciones extraer_* admiten dos motores (MOTOR_PARSEO) que producen exactamente los mismos
+# datos: "bs4" recorre el árbol completo de BeautifulSoup y "lxml" usa lxml.html con XPath
+# precompiladas, mucho más rápido y con menos memoria.
+
+@metricas.cronometrar("json_ld")
+def aplicar_json_ld(textos_scripts, details):
+    """Rellena en `details` los campos que vienen de los bloques <script type="application/ld+json">."""
+    def extract_names_from_json_list(data_list):
+        if not data_list: return None
+        names = []
+        if not isinstance(data_list, list): data_list = [data_list]
+        for entry in data_list:
+            if isinstance(entry, dict) and 'name' in entry: names.append(entry['name'].strip())
+            elif isinstance(entry, str): names.append(entry.strip())
+        return ", ".join(names) if names else None
+
+    json_ld_data_found_main_block = False # Para no sobreescribir si ya encontramos un bloque principal
+    for script_text in textos_scripts:
+        try:
+            data = json.loads(script_text)
+            items_to_check = []
+            if isinstance(data, dict): items_to_check.append(data)
+            elif isinstance(data, list): items_to_check.extend(data)
+
+            for item in items_to_check:
+                # Intentar procesar solo el bloque principal una vez para estos campos
+                # Esto es una heurística, puede que no siempre sea el primer bloque relevante
+                current_item_is_main_type = item.get("@type") in ["Movie", "TVEpisode", "TVSeries", "CreativeWork"]
+
+                if not json_ld_data_found_main_block or not current_item_is_main_type:
+                    if current_item_is_main_type:
+                        json_ld_data_found_main_block = True
+
+                    if 'director' in item and not details.get('director'):
+                         details['director'] = extract_names_from_json_list(item.get('director'))
+                    if 'actor' in item and not details.get('reparto'):
+                         details['reparto'] = extract_names_from_json_list(item.get('actor'))
+                    if 'musicBy' in item and not details.get('musica'):
+                         details['musica'] = extract_names_from_json_list(item.get('musicBy'))
+                    if 'producer' in item and not details.get('produccion'):
+                         details['produccion'] = extract_names_from_json_list(item.get('producer'))
+                    if 'productionCompany' in item and not details.get('productora'):
+                         details['productora'] = extract_names_from_json_list(item.get('productionCompany'))
+                    
+                    if 'aggregateRating' in item and isinstance(item['aggregateRating'], dict):
+                        if 'ratingValue' in item['aggregateRating'] and not details.get('ratingValue'):
+                            details['ratingValue'] = str(item['aggregateRating']['ratingValue'])
+                        if 'bestRating' in item['aggregateRating'] and not details.get('bestRating'):
+                            details['bestRating'] = str(item['aggregateRating']['bestRating'])
+                    elif 'ratingValue' in item and not details.get('ratingValue'):
+                         details['ratingValue'] = str(item.get('ratingValue'))
+
+                    if 'image' in item and not details.get('icon_url'):
+                        image_data = item['image']
+                        if isinstance(image_data, str): details['icon_url'] = image_data
+                        elif isinstance(image_data, dict) and image_data.get('@type') == 'ImageObject' and 'url' in image_data:
+                            details['icon_url'] = image_data['url']
+                        elif isinstance(image_data, list) and image_data:
+                            first_image = image_data[0]
+                            if isinstance(first_image, str): details['icon_url'] = first_image
+                            elif isinstance(first_image, dict) and first_image.get('@type') == 'ImageObject' and 'url' in first_image:
+                                details['icon_url'] = first_image['url']
+        except (json.JSONDecodeError, AttributeError):
+            continue
+
+
+def _extraer_detalles_bs4(texto_html, details):
+    soup = BeautifulSoup(texto_html, 'lxml')
+
+    # --- Extracción de meta etiquetas (og:title y sinopsis de name="description") ---
+    og_title_tag = soup.find('meta', property='og:title')
+    if og_title_tag and og_title_tag.get('content'):
+        details['og_titulo'] = og_title_tag['content'].strip()
+        log.debug("og:title = '%s'", details['og_titulo'])
+
+    desc_tag = soup.find('meta', attrs={'name': 'description'})
+    if desc_tag and desc_tag.get('content'):
+        full_description = html.unescape(desc_tag['content'].strip())
+        separator = " - "
+        separator_index = full_description.find(separator)
+        if separator_index != -1:
+            details['sinopsis'] = full_description[separator_index + len(separator):].strip()
+            # log.debug("Sinopsis (procesada) = '%s...'", details['sinopsis'][:50])
+        else:
+            details['sinopsis'] = full_description
+            # log.debug("Sinopsis (completa) = '%s...'", details['sinopsis'][:50])
+    
+    # --- NUEVA Extracción HTML para Categoria, Pais, Año, Calificacion ---
+    # Buscar primero el <ul>. Los <p> relevantes son hermanos que le siguen.
+    ul_info_movie = soup.find('ul', class_='list-info-movie')
+    if ul_info_movie:
+        log.debug("<ul class='list-info-movie'> encontrado.")
+        # El primer <p> hermano siguiente debería ser la categoría
+        p_categoria = ul_info_movie.find_next_sibling('p')
+        if p_categoria:
+            details['categoria'] = p_categoria.get_text(strip=True)
+            log.debug("Categoria (desde p) = '%s'", details['categoria'])
+            
+            # El segundo <p> hermano (hermano del p_categoria) debería ser País (Año)
+            p_pais_ano = p_categoria.find_next_sibling('p')
+            if p_pais_ano:
+                text_p_pais_ano = p_pais_ano.get_text(strip=True)
+                log.debug("Pais/Año P (texto) = '%s'", text_p_pais_ano)
+                match = re.search(r'^(.*?)\s*\((\d{4})\)$', text_p_pais_ano)
+                if match:
+                    details['pais'] = match.group(1).strip()
+                    details['año'] = match.group(2).strip()
+                    log.debug("País = '%s', Año = '%s'", details['pais'], details['año'])
+                else: # Si no hay año en paréntesis, asumir que todo es el país
+                    details['pais'] = text_p_pais_ano
+                    log.debug("País (sin año en formato esperado) = '%s'", details['pais'])
+            else:
+                log.debug("No se encontró el segundo <p> para País/Año.")
+        else:
+            log.debug("No se encontró el primer <p> para Categoría.")
+    else:
+        log.warning("<ul class='list-info-movie'> no encontrado.")
+
+    # Calificación (dentro de <div class="moral">)
+    moral_div = soup.find('div', class_='moral')
+    if moral_div:
+        log.debug("<div class='moral'> encontrado.")
+        # No es necesario buscar el h3 Calificación si la img está directamente en moral_div
+        # y es la única o la identificable por su 'alt'.
+        # El snippet muestra solo una img, asumimos que es la de calificación.
+        img_cal = moral_div.find('img', alt=True) 
+        if img_cal and img_cal.get('alt'):
+            details['calificacion'] = img_cal['alt'].strip()
+            log.debug("Calificación (alt de img) = '%s'", details['calificacion'])
+        else:
+            log.debug("No se encontró <img> con 'alt' en <div class='moral'>.")
+    else:
+        log.warning("<div class='moral'> no encontrado para Calificación.")
+        
+    # --- Extracción de Presentador, Guionista (como antes, ajustar si es necesario) ---
+    presentador_h3 = soup.find('h3', class_="heading", string=re.compile(r'Presentador', re.IGNORECASE))
+    if presentador_h3:
+        p_presentador = presentador_h3.find_next_sibling('p')
+        if p_presentador: details['presenta'] = p_presentador.get_text(strip=True)
+    
+    guionista_h3 = soup.find('h3', class_="heading", string=re.compile(r'Guionista', re.IGNORECASE))
+    if guionista_h3:
+        p_guionista = guionista_h3.find_next_sibling('p')
+        if p_guionista:
+            span_guionista = p_guionista.find('span')
+            details['guion'] = span_guionista.get_text(strip=True) if span_guionista else p_guionista.get_text(strip=True)
+
+    # --- Extracción de JSON-LD (rating, director, reparto, musica, produccion, productora, icon_url) ---
+    scripts_jsonld = soup.find_all('script', type='application/ld+json')
+    aplicar_json_ld((script.string for script in scripts_jsonld), details)
+
+
+def _xpath_clase(etiqueta, clase, prefijo='//'):
+    # Igual que class_=... en BeautifulSoup: basta con que `clase` sea una de las clases del elemento
+    return etree.XPath(f"{prefijo}{etiqueta}[contains(concat(' ', normalize-space(@class), ' '), ' {clase} ')]")
+
+_XP_OG_TITLE = etree.XPath("//meta[@property='og:title']")
+_XP_DESCRIPTION = etree.XPath("//meta[@name='description']")
+_XP_UL_INFO_MOVIE = _xpath_clase('ul', 'list-info-movie')
+_XP_DIV_MORAL = _xpath_clase('div', 'moral')
+_XP_IMG_ALT = etree.XPath(".//img[@alt]")
+_XP_H3_HEADING = _xpath_clase('h3', 'heading')
+_XP_SPAN = etree.XPath(".//span")
+_XP_JSON_LD = etree.XPath("//script[@type='application/ld+json']")
+_XP_CONTAINER_BOX = _xpath_clase('div', 'container_box')
+_XP_LINK = etree.XPath(".//a[@href]")
+_XP_LI_TITLE = _xpath_clase('li', 'title', './/')
+_XP_LI_TIME = _xpath_clase('li', 'time', './/')
+_RE_PRESENTADOR = re.compile(r'Presentador', re.IGNORECASE)
+_RE_GUIONISTA = re.compile(r'Guionista', re.IGNORECASE)
+_RE_PAIS_ANO = re.compile(r'^(.*?)\s*\((\d{4})\)$')
+_ETIQUETAS_SIN_TEXTO = ('script', 'style', 'template') # get_text() de BeautifulSoup no incluye su contenido
+
+def _arbol_lxml(texto_html):
+    """Árbol lxml.html del documento, o None si está vacío."""
+    try:
+        return lxml.html.document_fromstring(texto_html)
+    except ValueError: # Cadena con declaración de codificación: se parsea como bytes
+        return lxml.html.document_fromstring(texto_html.encode('utf-8'), parser=lxml.html.HTMLParser(encoding='utf-8'))
+    except etree.ParserError:
+        return None
+
+def _primero(xpath, nodo):
+    resultado = xpath(nodo)
+    return resultado[0] if resultado else None
+
+def _texto_lxml(elem):
+    """Equivalente a get_text(strip=True) de BeautifulSoup (sin comentarios ni contenido de <script>/<style>)."""
+    partes = []
+    def recorrer(e):
+        if e.text and e.tag not in _ETIQUETAS_SIN_TEXTO:
+            partes.append(e.text.strip())
+        for hijo in e:
+            if isinstance(hijo.tag, str):
+                recorrer(hijo)
+            if hijo.tail:
+                partes.append(hijo.tail.strip())
+    recorrer(elem)
+    return "".join(partes)
+
+def _cadena_lxml(elem):
+    """Equivalente a `.string` de BeautifulSoup: el texto si el elemento tiene un único hijo de texto, o None."""
+    hijos = list(elem)
+    if not hijos:
+        return elem.text
+    if elem.text or len(hijos) != 1 or hijos[0].tail:
+        return None
+    hijo = hijos[0]
+    return hijo.text if not isinstance(hijo.tag, str) else _cadena_lxml(hijo)
+
+def _siguiente_p(elem):
+    return next(elem.itersiblings('p'), None)
+
+def _h3_con_texto(arbol, patron):
+    for h3 in _XP_H3_HEADING(arbol):
+        cadena = _cadena_lxml(h3)
+        if cadena is not None and patron.search(cadena):
+            return h3
+    return None
+
+def _extraer_detalles_lxml(texto_html, details):
+    arbol = _arbol_lxml(texto_html)
+    if arbol is None:
+        return
+
+    og_title_tag = _primero(_XP_OG_TITLE, arbol)
+    if og_title_tag is not None and og_title_tag.get('content'):
+        details['og_titulo'] = og_title_tag.get('content').strip()
+
+    desc_tag = _primero(_XP_DESCRIPTION, arbol)
+    if desc_tag is not None and desc_tag.get('content'):
+        full_description = html.unescape(desc_tag.get('content').strip())
+        separator = " - "
+        separator_index = full_description.find(separator)
+        if separator_index != -1:
+            details['sinopsis'] = full_description[separator_index + len(separator):].strip()
+        else:
+            details['sinopsis'] = full_description
+
+    ul_info_movie = _primero(_XP_UL_INFO_MOVIE, arbol)
+    if ul_info_movie is not None:
+        p_categoria = _siguiente_p(ul_info_movie)
+        if p_categoria is not None:
+            details['categoria'] = _texto_lxml(p_categoria)
+            p_pais_ano = _siguiente_p(p_categoria)
+            if p_pais_ano is not None:
+                text_p_pais_ano = _texto_lxml(p_pais_ano)
+                match = _RE_PAIS_ANO.search(text_p_pais_ano)
+                if match:
+                    details['pais'] = match.group(1).strip()
+                    details['año'] = match.group(2).strip()
+                else:
+                    details['pais'] = text_p_pais_ano
+    else:
+        log.warning("<ul class='list-info-movie'> no encontrado.")
+
+    moral_div = _primero(_XP_DIV_MORAL, arbol)
+    if moral_div is not None:
+        img_cal = _primero(_XP_IMG_ALT, moral_div)
+        if img_cal is not None and img_cal.get('alt'):
+            details['calificacion'] = img_cal.get('alt').strip()
+    else:
+        log.warning("<div class='moral'> no encontrado para Calificación.")
+
+    presentador_h3 = _h3_con_texto(arbol, _RE_PRESENTADOR)
+    if presentador_h3 is not None:
+        p_presentador = _siguiente_p(presentador_h3)
+        if p_presentador is not None: details['presenta'] = _texto_lxml(p_presentador)
+
+    guionista_h3 = _h3_con_texto(arbol, _RE_GUIONISTA)
+    if guionista_h3 is not None:
+        p_guionista = _siguiente_p(guionista_h3)
+        if p_guionista is not None:
+            span_guionista = _primero(_XP_SPAN, p_guionista)
+            details['guion'] = _texto_lxml(span_guionista) if span_guionista is not None else _texto_lxml(p_guionista)
+
+    aplicar_json_ld((_cadena_lxml(script) for script in _XP_JSON_LD(arbol)), details)
+
+@metricas.cronometrar("parseo_fichas")
+def extraer_detalles(texto_html, details, motor=None):
+    """Extrae de la ficha HTML los campos de `details` (los rellena en el propio diccionario)."""
+    if (motor or MOTOR_PARSEO) == "bs4":
+        _extraer_detalles_bs4(texto_html, details)
+    else:
+        _extraer_detalles_lxml(texto_html, details)
+
+@metricas.cronometrar("parseo_parrillas")
+def extraer_parrilla(texto_html, motor=None):
+    """
+    Devuelve [(hora_inicio, titulo, href)] de los bloques 'container_box' de una parrilla que
+    tienen enlace, título y hora, o None si la página no contiene ningún bloque.
+    """
+    items = []
+    if (motor or MOTOR_PARSEO) == "bs4":
+        soup = BeautifulSoup(texto_html, 'lxml')
+        # Usamos una función lambda para que coincida aunque tenga más clases (ej. "container_box g_CN")
+        program_blocks = soup.find_all('div', class_=lambda c: c and 'container_box' in c.split())
+        for block in program_blocks:
+            link_tag = block.find('a', href=True)
+            title_tag = block.find('li', class_='title')
+            time_tag = block.find('li', class_='time')
+            if link_tag and title_tag and time_tag:
+                items.append((time_tag.get_text(strip=True), title_tag.get_text(strip=True), link_tag.get('href', '')))
+    else:
+        arbol = _arbol_lxml(texto_html)
+        program_blocks = _XP_CONTAINER_BOX(arbol) if arbol is not None else []
+        for block in program_blocks:
+            link_tag = _primero(_XP_LINK, block)
+            title_tag = _primero(_XP_LI_TITLE, block)
+            time_tag = _primero(_XP_LI_TIME, block)
+            if link_tag is not None and title_tag is not None and time_tag is not None:
+                items.append((_texto_lxml(time_tag), _texto_lxml(title_tag), link_tag.get('href', '')))
+    return items if program_blocks else None
+
+
+# --- Extracción en varios procesos ---
+def _extraer_lote(trabajos, motor):
+    """
+    Se ejecuta en los procesos de ParseadorProcesos. Extrae cada (tipo, contenido, codificación) y
+    devuelve [(error, resultado, segundos)]: de una ficha, sus valores en el orden de DETALLE_FIELDS
+    (una tupla pesa menos que el diccionario al volver al proceso principal); de una parrilla, lo
+    mismo que extraer_parrilla.
+    """
+    resultados = []
+    for tipo, contenido, codificacion in trabajos:
+        inicio = time.perf_counter()
+        try:
+            texto = str(contenido, codificacion or 'utf-8', errors='replace')
+            if tipo == "ficha":
+                details = dict.fromkeys(DETALLE_FIELDS)
+                extraer_detalles(texto, details, motor)
+                resultado = tuple(details.values())
+            else:
+                resultado = extraer_parrilla(texto, motor)
+            resultados.append((None, resultado, time.perf_counter() - inicio))
+        except Exception as e:
+            resultados.append((f"{type(e).__name__}: {e}", None, time.perf_counter() - inicio))
+    return resultados
+
+class ParseadorProcesos:
+    """
+    Extrae fichas y parrillas en un ProcessPoolExecutor para usar todos los núcleos: el parseo es
+    CPU puro y en hilos lo serializa el GIL. Los hilos de descarga entregan el HTML en bruto con
+    extraer() y reciben un futuro; un hilo propio agrupa las páginas en lotes de hasta `lote` (o las
+    que haya tras `espera` segundos) para que cada envío entre procesos compense.
+    """
+    def __init__(self, procesos=PARSEO_PROCESOS, lote=PARSEO_LOTE, espera=0.005, motor=None):
+        # forkserver/spawn en vez de fork: los hilos de descarga ya están en marcha al crear los procesos
+        metodo = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self._pool = ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context(metodo),
+                                         initializer=configurar_log, initargs=(logging.getLevelName(log.getEffectiveLevel()),))
+        self.procesos = procesos or os.cpu_count() or 1
+        self.lote = lote
+        self.espera = espera
+        self.motor = motor or MOTOR_PARSEO
+        self.paginas = self.lotes = 0
+        self._pendientes = []
+        self._condicion = threading.Condition()
+        self._cerrado = False
+        self._hilo = threading.Thread(target=self._enviar, name="parseador", daemon=True)
+        self._hilo.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+        return False
+
+    def extraer(self, tipo, contenido, codificacion=None):
+        """Futuro con la extracción de una página "ficha" (diccionario de DETALLE_FIELDS) o "parrilla"."""
+        futuro = Future()
+        with self._condicion:
+            self._pendientes.append((tipo, contenido, codificacion, futuro))
+            self._condicion.notify()
+        return futuro
+
+    def _enviar(self):
+        while True:
+            with self._condicion:
+                while not self._pendientes and not self._cerrado:
+                    self._condicion.wait()
+                if not self._pendientes:
+                    return
+                if len(self._pendientes) < self.lote and not self._cerrado:
+                    # Se da un momento para que se llene el lote
+                    self._condicion.wait_for(lambda: len(self._pendientes) >= self.lote or self._cerrado, self.espera)
+                lote, self._pendientes = self._pendientes[:self.lote], self._pendientes[self.lote:]
+                self.paginas += len(lote)
+                self.lotes += 1
+            futuros = [futuro for *_, futuro in lote]
+            try:
+                enviado = self._pool.submit(_extraer_lote, [trabajo[:3] for trabajo in lote], self.motor)
+            except Exception as e:
+                for futuro in futuros:
+                    futuro.set_exception(e)
+                continue
+            enviado.add_done_callback(lambda f, tipos=[t[0] for t in lote], futuros=futuros: self._repartir(f, tipos, futuros))
+
+    @staticmethod
+    def _repartir(enviado, tipos, futuros):
+        try:
+            resultados = enviado.result()
+        except Exception as e: # p. ej. BrokenProcessPool si un proceso muere
+            for futuro in futuros:
+                futuro.set_exception(e)
+            return
+        for tipo, futuro, (error, resultado, segundos) in zip(tipos, futuros, resultados):
+            metricas.anotar_etapa("parseo_fichas" if tipo == "ficha" else "parseo_parrillas", segundos)
+            if error is not None:
+                futuro.set_exception(RuntimeError(error))
+            else:
+                futuro.set_result(dict(zip(DETALLE_FIELDS, resultado)) if tipo == "ficha" else resultado)
+
+    def cerrar(self):
+        with self._condicion:
+            self._cerrado = True
+            self._condicion.notify()
+        self._hilo.join()
+        self._pool.shutdown()
+
+def _aplanar(futuro):
+    """
+    Futuro con el resultado final de `futuro` cuando este devuelve a su vez un futuro (como
+    obtener_detalles_programa con un ParseadorProcesos). Cancelarlo cancela el de la descarga
+    si aún no ha empezado.
+    """
+    final = Future()
+
+    def resolver(f):
+        try:
+            if f.cancelled():
+                final.cancel()
+            elif f.exception() is not None:
+                final.set_exception(f.exception())
+            elif isinstance(f.result(), Future):
+                f.result().add_done_callback(resolver)
+            else:
+                final.set_result(f.result())
+        except InvalidStateError: # Ya se había cancelado: el resultado solo queda en la caché
+            pass
+
+    final.add_done_callback(lambda f: f.cancelled() and futuro.cancel())
+    futuro.add_done_callback(resolver)
+    return final
+
+
+# MODIFICADA: Función para extraer todos los detalles necesarios
+def obtener_detalles_programa(detail_url, cache=None, parseador=None, desde_cache=None):
+    """
+    Obtiene múltiples detalles desde la URL de la ficha de un programa.
+    Devuelve un DetallesPrograma con los campos encontrados (None si no hay URL).
+    Si se pasa una `cache` (CacheDetalles), solo se descarga la ficha cuando no hay
+    una copia reciente, y el resultado se guarda en ella; las URLs servidas desde la caché
+    se añaden al conjunto `desde_cache`. Con un `parseador`
+    (ParseadorProcesos) la ficha descargada se extrae en otro proceso: se devuelve
+    enseguida un futuro con el DetallesPrograma y el hilo queda libre para otra descarga.
+    """
+    if not detail_url:
+        return None
+    entrada_cache = None
+    if cache is not None:
+        cached_details, entrada_cache = cache.obtener_fresca(detail_url)
+        if cached_details is not None:
+            if desde_cache is not None:
+                desde_cache.add(detail_url)
+            return DetallesPrograma.desde_dict(cached_details)
+    log.debug("Procesando detalles completos para: %s", detail_url)
+    
+    details = dict.fromkeys(DETALLE_FIELDS)
+
+    try:
+        limitador_peticiones.esperar()
+        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+        with metricas.etapa("descarga_fichas"):
+            response = cliente_http.get(detail_url, headers=headers, timeout=15,
+                                        etag=entrada_cache and entrada_cache["etag"],
+                                        last_modified=entrada_cache and entrada_cache["last_modified"])
+        if response.status_code == 304 and entrada_cache is not None:
+            cache.marcar_revalidada(detail_url, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            return DetallesPrograma.desde_dict(entrada_cache["detalles"])
+        response.raise_for_status()
+        if parseador is not None:
+            futuro = Future()
+            codificacion = response.encoding or getattr(response, "apparent_encoding", None)
+            def completar(extraccion):
+                # Un fallo aquí se perdería dentro de add_done_callback y el futuro no se resolvería nunca
+                try:
+                    futuro.set_result(_completar_ficha(detail_url, extraccion, response, cache))
+                except Exception as e:
+                    futuro.set_exception(e)
+            parseador.extraer("ficha", response.content, codificacion).add_done_callback(completar)
+            return futuro
+        extraer_detalles(response.text, details)
+
+        # Imprimir un resumen de lo encontrado para depuración final de esta función
+        log.debug("FINAL detalles: Cat='%s', Pais='%s', Año='%s', Calif='%s'",
+                  details.get('categoria'), details.get('pais'), details.get('año'), details.get('calificacion'))
+        # log.debug("FINAL detalles: Sinopsis='%s...', Rating='%s/%s', Director='%s', Icono='%s'", str(details.get('sinopsis'))[:30], details.get('ratingValue'), details.get('bestRating'), details.get('director'), details.get('icon_url') is not None)
+
+        # Solo se cachean las fichas descargadas y procesadas sin errores
+        if cache is not None:
+            cache.guardar(detail_url, details, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return DetallesPrograma.desde_dict(details)
+
+    except requests.exceptions.RequestException as e:
+        metricas.contar("fichas_error")
+        log.error(f"No se pudo obtener la página de detalle {detail_url}: {e}")
+        return DetallesPrograma.desde_dict(details) # Devuelve lo que se haya podido recoger hasta el momento
+    except Exception as e:
+        metricas.contar("fichas_error")
+        log.error(f"Error inesperado al procesar la página de detalle {detail_url}: {e}")
+        return DetallesPrograma.desde_dict(details)
+
+def _completar_ficha(detail_url, extraccion, response, cache):
+    """Termina obtener_detalles_programa cuando la ficha se ha extraído en un ParseadorProcesos."""
+    try:
+        details = extraccion.result()
+    except Exception as e:
+        metricas.contar("fichas_error")
+        log.error(f"Error inesperado al procesar la página de detalle {detail_url}: {e}")
+        return DetallesPrograma.desde_dict(dict.fromkeys(DETALLE_FIELDS))
+    try:
+        if cache is not None:
+            cache.guardar(detail_url, details, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    except Exception as e: # Como en obtener_detalles_programa: se devuelve lo extraído aunque no se haya guardado
+        metricas.contar("fichas_error")
+        log.error(f"Error inesperado al procesar la página de detalle {detail_url}: {e}")
+    return DetallesPrograma.desde_dict(details)
+
+class CoalescedorDetalles:
+    """
+    Garantiza que cada detail_url se descarga y procesa una sola vez por ejecución: todas las
+    peticiones de la misma URL (también las simultáneas) comparten el mismo futuro. Se recuerdan
+    como mucho `max_recordadas` fichas (las usadas hace más tiempo se olvidan; si vuelven a pedirse
+    las sirve la caché persistente). Con un `parseador` las fichas se extraen en sus procesos.
+    """
+    def __init__(self, executor, cache=None, max_recordadas=FICHAS_RECORDADAS, parseador=None):
+        self.executor = executor
+        self.cache = cache
+        self.parseador = parseador
+        self.max_recordadas = max_recordadas
+        self.solicitudes = 0
+        self.unicas = 0
+        self.desde_cache = set() # URLs que ha servido la caché persistente, sin descargarlas
+        self._futuros = OrderedDict()
+        self._lock = threading.Lock()
+
+    def solicitar(self, detail_url):
+        with self._lock:
+            self.solicitudes += 1
+            futuro = self._futuros.get(detail_url)
+            if futuro is None:
+                futuro = self.executor.submit(obtener_detalles_programa, detail_url, self.cache, self.parseador, self.desde_cache)
+                if self.parseador is not None:
+                    futuro = _aplanar(futuro)
+                self._futuros[detail_url] = futuro
+                self.unicas += 1
+                if len(self._futuros) > self.max_recordadas:
+                    self._futuros.popitem(last=False)
+            else:
+                self._futuros.move_to_end(detail_url)
+            return futuro
+
+    def resumen(self):
+        if not self.solicitudes:
+            return "sin peticiones de detalle"
+        ratio = self.solicitudes / self.unicas
+        ahorro = 100 * (1 - self.unicas / self.solicitudes)
+        return f"{self.solicitudes} programas -> {self.unicas} URLs únicas (ratio {ratio:.2f}, {ahorro:.1f}% evitadas)"
+
+
+# --- Canales y parrillas ---
+def cargar_canales(ruta):
+    """
+    Lee la lista de canales de un fichero: JSON (lista de CasIds o de objetos {"casid": ...})
+    o texto con un CasId por línea (se ignoran las líneas vacías y las que empiezan por #).
+    """
+    with open(ruta, encoding="UTF-8") as f:
+        contenido = f.read()
+    if ruta.endswith(".json"):
+        entradas = json.loads(contenido)
+        return [{"casid": str(e["casid"] if isinstance(e, dict) else e)} for e in entradas]
+    return [{"casid": linea.strip()} for linea in contenido.splitlines()
+            if linea.strip() and not linea.strip().startswith("#")]
+
+def resolver_canales(targets):
+    """
+    Resuelve cada canal en el índice del CSV. Devuelve, en el orden de `targets` y sin nombres
+    repetidos, un diccionario por canal válido con sus datos y los contadores que se irán
+    rellenando durante la ejecución (días, programas, reutilizados, segundos).
+    """
+    canales, nombres, fallidos = [], set(), []
+    for target in targets:
+        cas_id = target["casid"]
+        nombre_canal, logo_canal, cod_cadena_tv = obtener_datos_canal_csv(cas_id, CSV_URL)
+        if not nombre_canal or not logo_canal or not cod_cadena_tv:
+            log.warning(f"Datos CSV incompletos para CasId {cas_id}. Saltando.")
+            fallidos.append(cas_id)
+            continue
+        if nombre_canal in nombres:
+            log.warning(f"El canal '{nombre_canal}' (CasId {cas_id}) está repetido. Saltando.")
+            continue
+        nombres.add(nombre_canal)
+        canales.append({"casid": cas_id, "canal": nombre_canal, "logo": logo_canal, "cod": cod_cadena_tv,
+                        "dias": 0, "programas": 0, "reutilizados": 0, "segundos": 0.0})
+    if fallidos:
+        log.warning(f"{len(fallidos)} canales sin datos (CasId: {', '.join(fallidos)}).")
+    return canales
+
+def iterar_parrillas(canales, date_strings, executor, por_adelantado=PARRILLAS_POR_ADELANTADO, parseador=None):
+    """
+    Generador de (canal, fecha, programas) en orden canal -> día. Mantiene hasta `por_adelantado`
+    parrillas descargándose en `executor` por delante del consumidor. Un fallo en una parrilla
+    se registra y no detiene el resto. Con un `parseador` las parrillas se extraen en sus procesos.
+    """
+    def descargar(canal, date_str):
+        inicio = time.perf_counter()
+        programas = obtener_programacion_movistar(f"{BASE_PROGRAM_URL}{canal['cod']}/{date_str}", canal["canal"], parseador)
+        segundos = time.perf_counter() - inicio
+        metricas.anotar_etapa("parrillas", segundos)
+        return programas, segundos
+
+    def recoger(canal, date_str, futuro):
+        try:
+            programas, segundos = futuro.result()
+        except Exception as e:
+            log.error(f"Fallo inesperado en la parrilla de '{canal['canal']}' para {date_str}: {e}")
+            programas, segundos = [], 0.0
+        canal["segundos"] += segundos
+        if programas:
+            canal["dias"] += 1
+        else:
+            metricas.contar("parrillas_vacias")
+            log.warning(f"No se encontró programación para '{canal['canal']}' en {date_str}.")
+        return canal, date_str, programas
+
+    en_curso = deque()
+    for canal in canales:
+        for date_str in date_strings:
+            en_curso.append((canal, date_str, executor.submit(descargar, canal, date_str)))
+            if len(en_curso) >= por_adelantado:
+                yield recoger(*en_curso.popleft())
+    while en_curso:
+        yield recoger(*en_curso.popleft())
+
+def iterar_programas_detallados(parrillas, coalescedor, estado=None, profundidad=PIPELINE_PROFUNDIDAD):
+    """
+    Generador de (canal, fecha, programa) ya enriquecidos con sus detalles, en el mismo orden en que
+    llegan las parrillas. Cada programa lanza la descarga de su ficha al entrar y se entrega cuando
+    está resuelta, con como mucho `profundidad` programas en vuelo. Con `estado` (modo incremental)
+    las franjas sin cambios recuperan sus detalles y no se vuelven a descargar.
+    """
+    def completar(canal, date_str, programa, futuro):
+        if futuro is not None:
+            programa.detalles = futuro.result()
+        return canal, date_str, programa
+
+    en_vuelo = deque()
+    for canal, date_str, programas in parrillas:
+        pendientes = programas
+        if estado is not None:
+            pendientes = aplicar_estado_previo(programas, estado.obtener(canal["canal"], date_str))
+            canal["reutilizados"] += len(programas) - len(pendientes)
+        ids_pendientes = {id(p) for p in pendientes}
+        for programa in programas:
+            futuro = None
+            if id(programa) in ids_pendientes and programa.detail_url:
+                futuro = coalescedor.solicitar(programa.detail_url)
+            en_vuelo.append((canal, date_str, programa, futuro))
+            if len(en_vuelo) >= profundidad:
+                yield completar(*en_vuelo.popleft())
+    while en_vuelo:
+        yield completar(*en_vuelo.popleft())
+
+def descargar_fichas_priorizadas(programas, coalescedor, limite, en_vuelo_max=DETALLES_WORKERS):
+    """
+    Descarga las fichas de `programas` por orden de emisión: primero lo que empieza antes y, al
+    final, lo que ya ha terminado. Mantiene `en_vuelo_max` descargas lanzadas (una por hilo, para
+    que al agotarse el plazo no quede cola) y no lanza ninguna que, por lo que han tardado las
+    anteriores, no vaya a llegar antes de `limite` (epoch); las que no han empezado se cancelan y
+    las que están en curso terminan (y se guardan en la caché) sin que se las espere. Devuelve {url: detalles} de las fichas que han llegado a tiempo.
+    """
+    ahora = time.time()
+    orden = {}
+    for programa in programas:
+        inicio, fin = instante_xmltv(programa.inicio), instante_xmltv(programa.fin)
+        clave = (fin <= ahora, inicio)
+        if programa.detail_url not in orden or clave < orden[programa.detail_url]:
+            orden[programa.detail_url] = clave
+    urls = iter(sorted(orden, key=orden.get))
+    detalles, lanzados = {}, {}
+    # Se deja de lanzar cuando lo que tardan de media las últimas fichas descargadas (limitador
+    # incluido) ya no cabe antes del plazo; las que sirve la caché no cuentan
+    inicios, duraciones = {}, deque(maxlen=2 * en_vuelo_max)
+
+    def lanzar():
+        while len(lanzados) < en_vuelo_max:
+            latencia = sum(duraciones) / len(duraciones) if duraciones else 0.0
+            if time.time() + latencia >= limite:
+                return
+            url = next(urls, None)
+            if url is None:
+                return
+            futuro = coalescedor.solicitar(url)
+            lanzados[futuro] = url
+            inicios[futuro] = time.time()
+
+    lanzar()
+    while lanzados:
+        restante = limite - time.time()
+        if restante <= 0:
+            break
+        hechos, _ = wait(lanzados, timeout=restante, return_when=FIRST_COMPLETED)
+        for futuro in hechos:
+            url = lanzados.pop(futuro)
+            detalles[url] = futuro.result()
+            inicio = inicios.pop(futuro)
+            if url not in coalescedor.desde_cache:
+                duraciones.append(time.time() - inicio)
+        lanzar()
+    for futuro, url in lanzados.items():
+        if futuro.done() and not futuro.cancelled():
+            detalles[url] = futuro.result()
+        else:
+            futuro.cancel()
+    fuera_de_plazo = len(orden) - len(detalles)
+    if fuera_de_plazo:
+        log.warning(f"Presupuesto de tiempo agotado: {len(detalles)} de {len(orden)} fichas obtenidas; "
+                    f"{fuera_de_plazo} se quedan con los datos de la parrilla.")
+    metricas.contar("fichas_fuera_de_plazo", fuera_de_plazo)
+    return detalles
+
+def iterar_programas_priorizados(parrillas, coalescedor, limite, estado=None):
+    """
+    Variante de iterar_programas_detallados con presupuesto de tiempo: reúne primero todas las
+    parrillas, pide las fichas con descargar_fichas_priorizadas hasta `limite` y después entrega
+    los programas en el orden de siempre. A los que se quedan sin ficha se les pone la copia de la
+    caché aunque haya caducado y, si no hay, se escriben con el título de la parrilla.
+    """
+    dias, pendientes = [], []
+    for canal, date_str, programas in parrillas:
+        por_detallar = programas
+        if estado is not None:
+            por_detallar = aplicar_estado_previo(programas, estado.obtener(canal["canal"], date_str))
+            canal["reutilizados"] += len(programas) - len(por_detallar)
+        pendientes.extend(programa for programa in por_detallar if programa.detail_url)
+        dias.append((canal, date_str, programas))
+
+    detalles = descargar_fichas_priorizadas(pendientes, coalescedor, limite)
+    cache = coalescedor.cache
+    for programa in pendientes:
+        if programa.detail_url not in detalles and cache is not None:
+            entrada = cache.obtener(programa.detail_url)
+            detalles[programa.detail_url] = DetallesPrograma.desde_dict(entrada["detalles"]) if entrada else None
+        programa.detalles = detalles.get(programa.detail_url)
+
+    for canal, date_str, programas in dias:
+        for programa in programas:
+            yield canal, date_str, programa
+
+
+# --- Imágenes ---
+class AlmacenImagenes:
+    """
+    Etapa opcional de imágenes. Cada carátula se descarga una sola vez por URL y, si varias URLs
+    sirven la misma imagen, se guarda una sola vez por hash del contenido. Las miniaturas de
+    `anchos` se generan en paralelo en un pool de hilos (con Pillow; si no está instalado se
+    sirve la copia original). solicitar(url) devuelve un futuro con el src que hay que poner en el
+    XML, o la URL original si algo falla. Un índice SQLite en `directorio` relaciona URLs e
+    imágenes y guarda cuándo se usó cada una, para podar las que llevan más tiempo sin usarse.
+    """
+    def __init__(self, directorio=IMAGENES_DIR, url_base=IMAGENES_URL_BASE, anchos=MINIATURAS_ANCHOS,
+                 max_bytes=IMAGENES_MAX_MB * 1024 * 1024, workers=IMAGENES_WORKERS):
+        os.makedirs(directorio, exist_ok=True)
+        self.directorio = directorio
+        self.url_base = url_base
+        self.anchos = tuple(anchos) if Image is not None else ()
+        self.max_bytes = max_bytes
+        self.inicio = time.time()
+        self.conn = sqlite3.connect(os.path.join(directorio, "imagenes.sqlite"), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS imagenes (hash TEXT PRIMARY KEY, extension TEXT NOT NULL,
+                                                 bytes INTEGER NOT NULL, accedido REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT NOT NULL);""")
+        self._lock = threading.Lock()
+        self._futuros = {}
+        self._por_hash = {}
+        self._descargas = ThreadPoolExecutor(max_workers=workers)
+        self._pool_miniaturas = ThreadPoolExecutor(max_workers=workers)
+        self.descargadas = self.en_cache = self.repetidas = self.miniaturas = self.fallos = 0
+        if Image is None:
+            log.warning("Pillow no está instalado: se usarán las carátulas originales, sin miniaturas.")
+
+    def solicitar(self, url):
+        with self._lock:
+            futuro = self._futuros.get(url)
+            if futuro is None:
+                futuro = self._futuros[url] = self._descargas.submit(self._procesar, url)
+            return futuro
+
+    def _rutas(self, hash_, extension):
+        """Rutas relativas a `directorio`: las miniaturas (en orden de `anchos`) y, al final, el original."""
+        return [f"{ancho}/{hash_}.jpg" for ancho in self.anchos] + [f"originales/{hash_}{extension}"]
+
+    def _procesar(self, url):
+        try:
+            with self._lock:
+                fila = self.conn.execute("SELECT i.hash, i.extension FROM urls u JOIN imagenes i ON i.hash = u.hash "
+                                         "WHERE u.url = ?", (url,)).fetchone()
+            if fila is not None and all(os.path.exists(os.path.join(self.directorio, r)) for r in self._rutas(*fila)):
+                hash_, extension = fila
+                with self._lock:
+                    self.en_cache += 1
+            else:
+                with metricas.etapa("descarga_imagenes"):
+                    response = cliente_http.get(url, timeout=15)
+                    response.raise_for_status()
+                contenido = response.content
+                hash_ = hashlib.sha256(contenido).hexdigest()[:32]
+                extension = os.path.splitext(urlsplit(url).path)[1].lower()
+                extension = extension if re.fullmatch(r"\.[a-z0-9]{1,5}", extension) else ".img"
+                with self._lock:
+                    self.descargadas += 1
+                    generacion = self._por_hash.get(hash_)
+                    repetida = generacion is not None
+                    if not repetida:
+                        generacion = self._por_hash[hash_] = Future()
+                        existente = self.conn.execute("SELECT extension FROM imagenes WHERE hash = ?", (hash_,)).fetchone()
+                if not repetida:
+                    try:
+                        # Otra URL pudo traer la misma imagen en una ejecución anterior
+                        repetida = existente is not None and all(
+                            os.path.exists(os.path.join(self.directorio, r)) for r in self._rutas(hash_, existente[0]))
+                        generacion.set_result(existente[0] if repetida else self._guardar(hash_, extension, contenido))
+                    except Exception as e:
+                        generacion.set_exception(e)
+                if repetida:
+                    with self._lock:
+                        self.repetidas += 1
+                extension = generacion.result() # Si otra URL ya trajo esta imagen, se usa la suya
+            rutas = self._rutas(hash_, extension)
+            with self._lock:
+                self.conn.execute("INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)", (url, hash_))
+                self.conn.execute("INSERT OR REPLACE INTO imagenes (hash, extension, bytes, accedido) VALUES (?, ?, ?, ?)",
+                                  (hash_, extension, sum(os.path.getsize(os.path.join(self.directorio, r)) for r in rutas), time.time()))
+            return self.url_base + rutas[0]
+        except Exception as e:
+            with self._lock:
+                self.fallos += 1
+            log.warning(f"No se pudo preparar la carátula {url}: {e}")
+            return url
+
+    def _guardar(self, hash_, extension, contenido):
+        """Guarda el original y reparte sus miniaturas entre los hilos del pool. Devuelve la extensión usada."""
+        original = os.path.join(self.directorio, self._rutas(hash_, extension)[-1])
+        os.makedirs(os.path.dirname(original), exist_ok=True)
+        with open(original + ".tmp", "wb") as f:
+            f.write(contenido)
+        os.replace(original + ".tmp", original)
+        for futuro in [self._pool_miniaturas.submit(self._miniatura, original, hash_, ancho) for ancho in self.anchos]:
+            futuro.result()
+        return extension
+
+    def _miniatura(self, original, hash_, ancho):
+        with metricas.etapa("miniaturas"):
+            destino = os.path.join(self.directorio, f"{ancho}/{hash_}.jpg")
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            with Image.open(original) as imagen:
+                imagen.thumbnail((ancho, ancho * 4)) # Mantiene la proporción y nunca amplía
+                if imagen.mode not in ("RGB", "L"):
+                    imagen = imagen.convert("RGB")
+                imagen.save(destino + ".tmp", "JPEG", quality=80, optimize=True)
+            os.replace(destino + ".tmp", destino)
+        with self._lock:
+            self.miniaturas += 1
+
+    def podar(self):
+        """Borra las imágenes usadas hace más tiempo (nunca las de esta ejecución) hasta quedar bajo max_bytes."""
+        with self._lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM imagenes").fetchone()[0]
+            borradas = 0
+            for hash_, extension, tamano in self.conn.execute(
+                    "SELECT hash, extension, bytes FROM imagenes WHERE accedido < ? ORDER BY accedido", (self.inicio,)).fetchall():
+                if total <= self.max_bytes:
+                    break
+                for ruta in self._rutas(hash_, extension):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(self.directorio, ruta))
+                self.conn.execute("DELETE FROM imagenes WHERE hash = ?", (hash_,))
+                self.conn.execute("DELETE FROM urls WHERE hash = ?", (hash_,))
+                total -= tamano
+                borradas += 1
+            self.conn.commit()
+        if borradas:
+            log.info(f"Caché de imágenes: {borradas} carátulas descartadas (LRU).")
+        return borradas
+
+    def resumen(self):
+        return (f"{len(self._futuros)} URLs, {self.descargadas} descargadas, {self.en_cache} ya en caché, "
+                f"{self.repetidas} repetidas por contenido, {self.miniaturas} miniaturas, {self.fallos} fallos")
+
+    def cerrar(self):
+        self._descargas.shutdown()
+        self._pool_miniaturas.shutdown()
+        self.podar()
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+def iterar_con_iconos(programas, imagenes, profundidad=PIPELINE_PROFUNDIDAD):
+    """
+    Etapa de imágenes del pipeline: pide a `imagenes` la carátula de cada programa al pasar y lo
+    entrega cuando está lista, con como mucho `profundidad` programas esperando.
+    """
+    en_espera = deque()
+    for canal, date_str, programa in programas:
+        icono = programa.detalles.icon_url if programa.detalles is not None else None
+        en_espera.append((canal, date_str, programa, imagenes.solicitar(icono) if icono else None))
+        if len(en_espera) >= profundidad:
+            canal_listo, fecha_lista, programa_listo, futuro = en_espera.popleft()
+            if futuro is not None:
+                futuro.result()
+            yield canal_listo, fecha_lista, programa_listo
+    for canal, date_str, programa, futuro in en_espera:
+        if futuro is not None:
+            futuro.result()
+        yield canal, date_str, programa
+
+
+# --- Modo incremental ---
+def clave_franja(programa):
+    """Identifica una franja de la parrilla: hora de inicio, título y URL de la ficha."""
+    return (programa.inicio, programa.original_titulo, programa.detail_url)
+
+class EstadoIncremental:
+    """
+    Estado del modo incremental en SQLite: los programas ya detallados de cada (canal, día).
+    Se consulta y se actualiza día a día, sin cargar en memoria la guía anterior completa.
+    """
+    def __init__(self, ruta):
+        self.conn = sqlite3.connect(ruta)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS dias (
+            canal TEXT NOT NULL, fecha TEXT NOT NULL, programas TEXT NOT NULL, PRIMARY KEY (canal, fecha))""")
+        self.conn.commit()
+
+    def obtener(self, canal, fecha):
+        row = self.conn.execute("SELECT programas FROM dias WHERE canal = ? AND fecha = ?", (canal, fecha)).fetchone()
+        return [Programa.desde_dict(datos) for datos in json.loads(row[0])] if row else None
+
+    def guardar(self, canal, fecha, programas):
+        self.conn.execute("INSERT OR REPLACE INTO dias (canal, fecha, programas) VALUES (?, ?, ?)",
+                          (canal, fecha, json.dumps([programa.como_dict() for programa in programas], ensure_ascii=False)))
+        self.conn.commit()
+
+    def purgar_anteriores(self, fecha):
+        """Elimina los días anteriores a `fecha` (ya emitidos, no se volverán a comparar)."""
+        borrados = self.conn.execute("DELETE FROM dias WHERE fecha < ?", (fecha,)).rowcount
+        self.conn.commit()
+        return borrados
+
+    def cerrar(self):
+        self.conn.close()
+
+def aplicar_estado_previo(programas_dia, previos_dia):
+    """
+    Compara la parrilla recién descargada de un día con la de la ejecución anterior.
+    Las franjas sin cambios (misma clave_franja y con detalles ya obtenidos) recuperan sus
+    detalles; se devuelve la lista de franjas nuevas o cambiadas que hay que detallar.
+    """
+    previos = {clave_franja(p): p for p in previos_dia or []}
+    pendientes = []
+    for programa in programas_dia:
+        previo = previos.get(clave_franja(programa))
+        if previo is not None and previo.detalles is not None:
+            programa.detalles = previo.detalles
+        else:
+            pendientes.append(programa)
+    return pendientes
+
+
+DESC_NO_DISPONIBLE = "(Información detallada no disponible)"
+# Plantilla del <desc> a partir de la tercera línea: (prefijo, campo) en orden; solo se añaden los campos con valor
+_PLANTILLA_DESC = tuple((f"· {etiqueta}: ", campo) for etiqueta, campo in (
+    ("País", 'pais'), ("Presenta", 'presenta'), ("Director", 'director'), ("Reparto", 'reparto'),
+    ("Guion", 'guion'), ("Música", 'musica'), ("Producción", 'produccion'), ("Productora", 'productora')))
+
+def componer_titulo(programa):
+    detalles = programa.detalles
+    return (detalles is not None and detalles.og_titulo) or programa.original_titulo or "Título no disponible"
+
+def componer_descripcion(programa):
+    """
+    Texto del <desc>: línea de categoría/calificación/valoración, sinopsis y campos con etiqueta.
+    Se compone una vez por ficha y se reutiliza en todas sus emisiones.
+    """
+    detalles = programa.detalles
+    if detalles is None:
+        return DESC_NO_DISPONIBLE
+    if detalles._descripcion is None:
+        detalles._descripcion = _componer_descripcion(detalles)
+    return detalles._descripcion
+
+def _componer_descripcion(detalles):
+    desc_parts = []
+    # Linea 1: %categoria% | %calificacion% | *%ratingValue%/%bestRating% (el año no se muestra)
+    line1_elements = [valor for valor in (detalles.categoria, detalles.calificacion) if valor]
+    if detalles.ratingValue:
+        line1_elements.append(f"*{detalles.ratingValue}/{detalles.bestRating}" if detalles.bestRating else f"*{detalles.ratingValue}")
+    if line1_elements: desc_parts.append(" | ".join(line1_elements))
+
+    # Sinopsis
+    if detalles.sinopsis: desc_parts.append(f"· {detalles.sinopsis}")
+
+    # Campos adicionales con etiqueta
+    for prefijo, campo in _PLANTILLA_DESC:
+        valor = getattr(detalles, campo)
+        if valor: desc_parts.append(prefijo + valor)
+
+    return "\n".join(desc_parts) if desc_parts else DESC_NO_DISPONIBLE
+
+
+# --- Benchmark de motores de extracción ---
+def benchmark_parseo(rutas=None, repeticiones=5, procesos=0, paginas_procesos=2000):
+    """
+    Compara los motores "bs4" y "lxml" sobre páginas HTML guardadas (ficheros, directorios con
+    .html o grabaciones de generar --grabar; por defecto PAGINAS_BENCH_PARSEO): tiempo medio de
+    parseo por página, pico de memoria y si ambos extraen los mismos datos.
+    Las páginas con bloques 'container_box' se tratan como parrillas y el resto como fichas.
+    Con `procesos`, mide además páginas/s al extraer `paginas_procesos` páginas con MOTOR_PARSEO
+    en serie y con ParseadorProcesos de 1 a `procesos` procesos.
+    """
+    ficheros = []
+    for ruta in rutas or [PAGINAS_BENCH_PARSEO]:
+        if os.path.isfile(os.path.join(ruta, "index.json")):
+            with open(os.path.join(ruta, "index.json"), encoding="UTF-8") as f:
+                respuestas = json.load(f)["respuestas"]
+            ficheros.extend(sorted(os.path.join(ruta, r["fichero"]) for r in respuestas.values()
+                                   if "html" in (r.get("content_type") or "")))
+        elif os.path.isdir(ruta):
+            ficheros.extend(sorted(os.path.join(ruta, f) for f in os.listdir(ruta) if f.endswith(('.html', '.htm'))))
+        else:
+            ficheros.append(ruta)
+    if not ficheros:
+        log.error("No se encontraron ficheros HTML para el benchmark.")
+        return
+
+    def ejecutar(texto, es_parrilla, motor):
+        try:
+            if es_parrilla:
+                return extraer_parrilla(texto, motor)
+            details = dict.fromkeys(DETALLE_FIELDS)
+            extraer_detalles(texto, details, motor)
+            return details
+        except Exception as e:
+            return f"ERROR: {e!r}"
+
+    print(f"{'Página':<40} {'tipo':<8} {'bs4 ms':>8} {'lxml ms':>8} {'x':>6} {'bs4 KiB':>9} {'lxml KiB':>9}  iguales")
+    totales = {"bs4": [0.0, 0], "lxml": [0.0, 0]}
+    distintas = 0
+    for fichero in ficheros:
+        with open(fichero, encoding="utf-8", errors="replace") as f:
+            texto = f.read()
+        es_parrilla = 'container_box' in texto
+        medidas = {}
+        for motor in ("bs4", "lxml"):
+            with log_silenciado():
+                inicio = time.perf_counter()
+                for _ in range(repeticiones):
+                    resultado = ejecutar(texto, es_parrilla, motor)
+                segundos = (time.perf_counter() - inicio) / repeticiones
+                tracemalloc.start()
+                ejecutar(texto, es_parrilla, motor)
+                pico = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            medidas[motor] = (segundos, pico, resultado)
+            totales[motor][0] += segundos
+            totales[motor][1] = max(totales[motor][1], pico)
+        iguales = medidas["bs4"][2] == medidas["lxml"][2]
+        distintas += not iguales
+        print(f"{os.path.basename(fichero)[:40]:<40} {'parrilla' if es_parrilla else 'ficha':<8} "
+              f"{medidas['bs4'][0] * 1000:>8.2f} {medidas['lxml'][0] * 1000:>8.2f} "
+              f"{medidas['bs4'][0] / max(medidas['lxml'][0], 1e-9):>6.1f} "
+              f"{medidas['bs4'][1] / 1024:>9.0f} {medidas['lxml'][1] / 1024:>9.0f}  {'sí' if iguales else 'NO'}")
+    n = len(ficheros)
+    log.info(f"{n} páginas. Media por página: bs4 {totales['bs4'][0] / n * 1000:.2f} ms, lxml {totales['lxml'][0] / n * 1000:.2f} ms "
+             f"(x{totales['bs4'][0] / max(totales['lxml'][0], 1e-9):.1f}). Pico de memoria: bs4 {totales['bs4'][1] / 1024:.0f} KiB, "
+             f"lxml {totales['lxml'][1] / 1024:.0f} KiB.")
+    if distintas:
+        log.warning(f"{distintas} páginas con resultados distintos entre motores.")
+    if procesos:
+        benchmark_procesos(ficheros, procesos, paginas_procesos)
+
+def benchmark_procesos(ficheros, procesos, n_paginas):
+    """Páginas/s de la extracción en serie y con ParseadorProcesos, comprobando que el resultado es el mismo."""
+    paginas = []
+    for fichero in ficheros:
+        with open(fichero, "rb") as f:
+            contenido = f.read()
+        paginas.append(("parrilla" if b'container_box' in contenido else "ficha", contenido, "utf-8"))
+    paginas = (paginas * (n_paginas // len(paginas) + 1))[:n_paginas]
+    with log_silenciado():
+        inicio = time.perf_counter()
+        esperado = [resultado for _, resultado, _ in _extraer_lote(paginas, MOTOR_PARSEO)]
+        serie = time.perf_counter() - inicio
+    print(f"\n{'Procesos':<10} {'páginas/s':>10} {'x':>6}  iguales")
+    print(f"{'en serie':<10} {n_paginas / serie:>10.0f} {1.0:>6.2f}  sí")
+    for n in sorted({1, procesos} | {2 ** i for i in range(1, procesos.bit_length()) if 2 ** i < procesos}):
+        with log_silenciado(), ParseadorProcesos(n) as parseador:
+            # Se arrancan los procesos antes de medir
+            wait([parseador.extraer(*paginas[i % len(paginas)]) for i in range(n * parseador.lote)])
+            inicio = time.perf_counter()
+            futuros = [parseador.extraer(*pagina) for pagina in paginas]
+            wait(futuros)
+            segundos = time.perf_counter() - inicio
+        obtenido = [None if f.exception() is not None else tuple(f.result().values()) if tipo == "ficha" else f.result()
+                    for (tipo, _, _), f in zip(paginas, futuros)]
+        print(f"{n:<10} {n_paginas / segundos:>10.0f} {serie / segundos:>6.2f}  {'sí' if obtenido == esperado else 'NO'}")
+    log.info(f"{n_paginas} páginas, {os.cpu_count()} núcleos, lotes de {PARSEO_LOTE} páginas, motor {MOTOR_PARSEO}.")
+
+
+# --- Script Principal ---
+def generar_epg(targets=None, dias=DIAS_A_PROCESAR, grid_workers=GRID_WORKERS, gzip_salida=SALIDA_GZIP, informe=INFORME_FILE,
+                desde=None, grabar=None, persistente=True, presupuesto=PRESUPUESTO_SEGUNDOS, imagenes=IMAGENES,
+                delta=DELTA_FILE):
+    """
+    Genera OUTPUT_XML_FILE con la programación y los detalles de `targets` (por defecto TARGET_CHANNELS)
+    durante `dias` días a partir de `desde` (por defecto hoy).
+    Con `informe` se escribe al final el informe de métricas de la ejecución (ver escribir_informe).
+    Con `grabar` se guardan en ese directorio todas las respuestas descargadas (ver GrabadorRespuestas).
+    Al grabar, o con `persistente=False`, no se usan las cachés ni el estado incremental.
+    Con `presupuesto` (segundos desde el inicio) las fichas se piden por orden de emisión y, al
+    agotarse el tiempo, se escribe la guía con las que se hayan obtenido (ver iterar_programas_priorizados).
+    Con `imagenes` los <icon> de los programas apuntan a miniaturas locales (ver AlmacenImagenes).
+    La guía solo se reescribe si su contenido ha cambiado; con `delta` se escriben además los
+    cambios por canal y día respecto a la anterior (ver escribir_delta), salvo que no haya cambiado.
+    Las etapas parrilla -> detalles -> XML funcionan en cadena: cada programa se escribe en cuanto
+    sus detalles están resueltos, así que la memoria depende de la profundidad del pipeline y no
+    del tamaño de la guía.
+    Devuelve None si la guía (y el delta) se han escrito o no han cambiado y, si no, el motivo del fallo.
+    """
+    targets = targets or TARGET_CHANNELS
+    print(f"--- Iniciando generación de EPG XML con descripciones completas ({len(targets)} canales, {dias} días) ---")
+    log.warning(f"Este proceso será MUY largo debido al scraping detallado.")
+    start_time_global = time.time()
+    today = desde or datetime.now(LOCAL_TIMEZONE).date()
+    dates_to_process = [today + timedelta(days=i) for i in range(dias)]
+    date_strings = [d.strftime('%Y-%m-%d') for d in dates_to_process]
+    log.info(f"Se procesarán las fechas: {', '.join(date_strings)}")
+
+    persistente = persistente and not grabar
+    if grabar:
+        cliente_http.grabador = GrabadorRespuestas(grabar, desde=date_strings[0], dias=dias,
+                                                   canales=[target["casid"] for target in targets])
+    if persistente and CACHE_RESPUESTAS_FILE:
+        cliente_http.abrir_almacen(CACHE_RESPUESTAS_FILE)
+    cache_detalles = CacheDetalles(CACHE_DETALLES_FILE) if persistente and CACHE_DETALLES_FILE else None
+    estado = EstadoIncremental(ESTADO_FILE) if persistente and MODO_INCREMENTAL else None
+
+    canales = resolver_canales(targets)
+
+    print(f"\n--- Generando archivo XML combinado ({dias} días) con descripciones completas ---")
+    log.info(f"Parrillas con {grid_workers} hilos; fichas con {DETALLES_WORKERS} hilos, máx. {limitador_peticiones.tasa:g} peticiones/s, "
+             f"{PIPELINE_PROFUNDIDAD} programas en vuelo.")
+    fecha_actual = datetime.now().strftime("%d/%m/%Y %H:%M")
+    rutas_salida = [OUTPUT_XML_FILE] + ([OUTPUT_XML_FILE + ".gz"] if gzip_salida else [])
+    if delta:
+        franjas_anteriores = huellas_franjas(OUTPUT_XML_FILE)
+        huella_anterior = huella_xmltv(OUTPUT_XML_FILE) if os.path.exists(OUTPUT_XML_FILE) else None
+    if PARSEO_PROCESOS:
+        log.info(f"Extracción de fichas y parrillas en {PARSEO_PROCESOS} procesos, en lotes de hasta {PARSEO_LOTE} páginas.")
+    # El parseador se cierra el último: los hilos de descarga le siguen entregando páginas hasta que terminan
+    with (ParseadorProcesos(PARSEO_PROCESOS) if PARSEO_PROCESOS else contextlib.nullcontext()) as parseador, \
+         ThreadPoolExecutor(max_workers=grid_workers) as executor_parrillas, \
+         ThreadPoolExecutor(max_workers=DETALLES_WORKERS) as executor_detalles:
+        coalescedor = CoalescedorDetalles(executor_detalles, cache_detalles, parseador=parseador)
+        parrillas = iterar_parrillas(canales, date_strings, executor_parrillas, parseador=parseador)
+        if presupuesto:
+            log.info(f"Presupuesto de {presupuesto:g} s: las fichas se piden por orden de emisión.")
+            programas = iterar_programas_priorizados(parrillas, coalescedor, start_time_global + presupuesto, estado)
+        else:
+            programas = iterar_programas_detallados(parrillas, coalescedor, estado)
+        almacen_imagenes = AlmacenImagenes(IMAGENES_DIR, IMAGENES_URL_BASE, MINIATURAS_ANCHOS) if imagenes else None
+        if almacen_imagenes is not None:
+            programas = iterar_con_iconos(programas, almacen_imagenes)
+        error = None
+        try:
+            # El índice se abre antes para cerrarse después: solo se publica si el XML se ha escrito bien
+            with (EscritorIndiceGuia(ruta_indice_guia(OUTPUT_XML_FILE)) if INDICE_GUIA else contextlib.nullcontext()) as indice_guia, \
+                 EscritorXMLTV(rutas_salida, f"MultiPopUps FullDesc {fecha_actual}") as escritor:
+                for canal in canales:
+                    escritor.canal(canal["canal"], canal["canal"], canal["logo"])
+                    if indice_guia is not None:
+                        indice_guia.canal(canal["canal"], canal["canal"], canal["logo"])
+                log.info(f"Añadidos {len(canales)} canales al XML.")
+
+                dia_actual, programas_dia = None, []
+                for canal, date_str, prog_data in programas:
+                    if estado is not None and (canal["canal"], date_str) != dia_actual:
+                        # Día completo: se guarda en el estado incremental y se libera
+                        if dia_actual is not None:
+                            estado.guardar(*dia_actual, programas_dia)
+                        dia_actual, programas_dia = (canal["canal"], date_str), []
+                    programas_dia.append(prog_data)
+
+                    if not prog_data.inicio or not prog_data.fin:
+                        log.warning(f"Programa '{prog_data.original_titulo}' omitido por falta de hora de inicio/fin.")
+                        metricas.contar("programas_omitidos")
+                        continue
+                    with metricas.etapa("composicion_xml"):
+                        titulo, descripcion = componer_titulo(prog_data), componer_descripcion(prog_data)
+                    icon_src = prog_data.detalles.icon_url if prog_data.detalles is not None else None
+                    if icon_src and almacen_imagenes is not None:
+                        icon_src = almacen_imagenes.solicitar(icon_src).result() # Ya resuelto en iterar_con_iconos
+                    with metricas.etapa("escritura_xml"):
+                        escritor.programa(prog_data.inicio, prog_data.fin, canal["canal"], titulo, descripcion, icon_src)
+                        if indice_guia is not None:
+                            indice_guia.programa(prog_data.inicio, prog_data.fin, canal["canal"], titulo)
+                    canal["programas"] += 1
+                    if escritor.programas == 1:
+                        log.info(f"Primer programa escrito a los {time.time() - start_time_global:.2f} segundos.")
+                    log.debug("Prog %d ('%s...')", escritor.programas, (prog_data.original_titulo or 'Desconocido')[:35])
+                if estado is not None and dia_actual is not None:
+                    estado.guardar(*dia_actual, programas_dia)
+
+            log.info(f"Total de {escritor.programas} programas añadidos al XML.")
+            if escritor.sin_cambios:
+                log.info(f"La guía no ha cambiado (huella {escritor.huella[:12]}): se conservan '{', '.join(rutas_salida)}'.")
+            else:
+                log.info(f"Archivo XML generado exitosamente: '{', '.join(rutas_salida)}' (huella {escritor.huella[:12]})")
+            if delta and not escritor.sin_cambios: # Sin cambios se conserva el delta anterior, que sigue llevando a la huella actual
+                error = escribir_delta(delta, OUTPUT_XML_FILE, franjas_anteriores, huella_anterior, escritor.huella)
+        except Exception as e:
+            error = f"No se pudo escribir el archivo XML: {e}"
+            log.error(error)
+
+    for canal in canales:
+        log.info(f"'{canal['canal']}' (CasId {canal['casid']}): {canal['programas']} programas en {canal['dias']}/{dias} días"
+                 + (f", {canal['reutilizados']} franjas reutilizadas" if estado is not None else "")
+                 + f", parrillas en {canal['segundos']:.2f} s")
+    log.info(f"Deduplicación de fichas: {coalescedor.resumen()}")
+    if almacen_imagenes is not None:
+        log.info(f"Carátulas: {almacen_imagenes.resumen()}")
+        almacen_imagenes.cerrar()
+    if cache_detalles is not None:
+        log.info(f"Caché de detalles: {cache_detalles.aciertos} aciertos, {cache_detalles.fallos} sin copia reciente "
+                 f"({cache_detalles.revalidadas} revalidadas con 304).")
+        cache_detalles.cerrar()
+    if estado is not None:
+        # Los días ya pasados no se volverán a comparar
+        estado.purgar_anteriores(date_strings[0])
+        estado.cerrar()
+    cliente_http.imprimir_estadisticas()
+    metricas.imprimir_etapas()
+    metricas.contar("programas_escritos", sum(canal["programas"] for canal in canales))
+    metricas.contar("franjas_reutilizadas", sum(canal["reutilizados"] for canal in canales))
+    if informe:
+        datos = metricas.informe(
+            inicio=start_time_global, fin=time.time(), duracion_segundos=time.time() - start_time_global,
+            canales=[{k: canal[k] for k in ("casid", "canal", "dias", "programas", "reutilizados", "segundos")} for canal in canales],
+            fichas={"solicitudes": coalescedor.solicitudes, "unicas": coalescedor.unicas,
+                    **({"cache_aciertos": cache_detalles.aciertos, "cache_fallos": cache_detalles.fallos,
+                        "cache_revalidadas": cache_detalles.revalidadas} if cache_detalles is not None else {})},
+            http=cliente_http.estadisticas())
+        try:
+            escribir_informe(informe, datos)
+        except OSError as e:
+            log.error(f"No se pudo escribir el informe '{informe}': {e}")
+    cliente_http.cerrar()
+
+    end_time_global = time.time()
+    print(f"--- Proceso finalizado en {end_time_global - start_time_global:.2f} segundos ---")
+    return error
+
+
+# --- Benchmark del modelo de datos ---
+def benchmark_modelo(n_programas=50000, n_fichas=5000, repeticiones=3):
+    """
+    Compara, sobre una guía sintética de `n_programas` emisiones de `n_fichas` fichas distintas,
+    el modelo Programa/DetallesPrograma con el diccionario plano por programa que se usaba antes:
+    memoria por programa y tiempo de composición del título y la <desc> (comprobando que el texto
+    es el mismo).
+    """
+    azar = random.Random(0)
+    categorias = ["Cine", "Comedia", "Drama", "Documental", "Deportes", "Infantil"]
+    paises = ["España", "Estados Unidos", "Francia", "Reino Unido"]
+    fichas = [DetallesPrograma.desde_dict({
+        "og_titulo": f"Título {i}", "sinopsis": f"Sinopsis de la ficha {i}. " * 6,
+        "categoria": azar.choice(categorias), "pais": azar.choice(paises), "año": str(1950 + i % 70),
+        "calificacion": "No recomendado para menores de 12 años", "ratingValue": str(i % 10), "bestRating": "10",
+        "director": f"Director {i}", "reparto": f"Actor {i}, Actriz {i}", "productora": azar.choice(["Prod A", "Prod B"]),
+    }) for i in range(n_fichas)]
+    parrilla = [(f"Título {i % n_fichas}", f"2024010{i % 9}{i % 24:02d}0000 +0100", f"2024010{i % 9}{i % 24:02d}3000 +0100",
+                 "Canal", f"https://example.invalid/ficha/{i % n_fichas}") for i in range(n_programas)]
+
+    def medir_memoria(construir):
+        tracemalloc.start()
+        antes = tracemalloc.get_traced_memory()[0]
+        objetos = construir()
+        despues = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return objetos, (despues - antes) / n_programas
+
+    # Referencia: la composición original sobre el diccionario plano
+    def componer_dict(prog_data):
+        desc_parts = []
+        line1_elements = []
+        if prog_data.get('categoria'): line1_elements.append(prog_data['categoria'])
+        if prog_data.get('calificacion'): line1_elements.append(prog_data['calificacion'])
+        rating_val, best_rat = prog_data.get('ratingValue'), prog_data.get('bestRating')
+        if rating_val and best_rat: line1_elements.append(f"*{rating_val}/{best_rat}")
+        elif rating_val: line1_elements.append(f"*{rating_val}")
+        if line1_elements: desc_parts.append(" | ".join(line1_elements))
+        if prog_data.get('sinopsis'): desc_parts.append(f"· {prog_data['sinopsis']}")
+        def add_labeled_part(label, key):
+            value = prog_data.get(key)
+            if value: desc_parts.append(f"· {label}: {value}")
+        for label, key in (("País", 'pais'), ("Presenta", 'presenta'), ("Director", 'director'), ("Reparto", 'reparto'),
+                           ("Guion", 'guion'), ("Música", 'musica'), ("Producción", 'produccion'), ("Productora", 'productora')):
+            add_labeled_part(label, key)
+        titulo = prog_data.get("og_titulo") or prog_data.get("original_titulo") or "Título no disponible"
+        return titulo, "\n".join(desc_parts) if desc_parts else DESC_NO_DISPONIBLE
+
+    def componer_modelo(programa):
+        return componer_titulo(programa), componer_descripcion(programa)
+
+    # Antes: un diccionario por emisión con los campos de la parrilla más update() con los 16 de la ficha
+    def construir_dicts():
+        dicts = []
+        for i, (titulo, inicio, fin, canal, url) in enumerate(parrilla):
+            prog_data = {"original_titulo": titulo, "inicio": inicio, "fin": fin, "canal_nombre": canal, "detail_url": url}
+            prog_data.update(fichas[i % n_fichas].como_dict())
+            dicts.append(prog_data)
+        return dicts
+    dicts, bytes_dict = medir_memoria(construir_dicts)
+    modelos, bytes_modelo = medir_memoria(lambda: [Programa(*datos, fichas[i % n_fichas]) for i, datos in enumerate(parrilla)])
+    tiempos = {}
+    for nombre, componer, datos in (("dict", componer_dict, dicts), ("modelo", componer_modelo, modelos)):
+        mejor = float("inf")
+        for _ in range(repeticiones):
+            for programa in modelos:
+                if programa.detalles is not None:
+                    programa.detalles._descripcion = None
+            inicio = time.perf_counter()
+            resultado = [componer(programa) for programa in datos]
+            mejor = min(mejor, time.perf_counter() - inicio)
+        tiempos[nombre] = (mejor, resultado)
+    iguales = tiempos["dict"][1] == tiempos["modelo"][1]
+    print(f"{'Representación':<16} {'bytes/prog':>10} {'µs/prog':>8}")
+    print(f"{'dict':<16} {bytes_dict:>10.0f} {tiempos['dict'][0] / n_programas * 1e6:>8.2f}")
+    print(f"{'modelo':<16} {bytes_modelo:>10.0f} {tiempos['modelo'][0] / n_programas * 1e6:>8.2f}")
+    log.info(f"{n_programas} programas de {n_fichas} fichas: memoria x{bytes_dict / max(bytes_modelo, 1):.1f} menos, "
+             f"composición x{tiempos['dict'][0] / max(tiempos['modelo'][0], 1e-9):.1f} más rápida; "
+             f"textos {'idénticos' if iguales else 'DISTINTOS'}.")
+    return iguales
+
+
+# --- Benchmark de extremo a extremo ---
+ETAPAS_BENCH = ("csv", "parrillas", "parseo_parrillas", "descarga_fichas", "parseo_fichas", "json_ld",
+                "composicion_xml", "escritura_xml")
+
+def benchmark(grabacion, variantes=None, repeticiones=3, latencia=0.0, tasa_errores=0.0, tasa=None):
+    """
+    Repite generar_epg contra la grabación `grabacion` (servida por ServidorReplay, sin red y sin
+    cachés persistentes) con cada variante de VARIANTES_BENCH, y muestra programas/s y los
+    segundos de cada etapa (medias de `repeticiones` ejecuciones). `tasa` sustituye al límite
+    de peticiones por segundo (0 = sin límite).
+    """
+    global cliente_http, limitador_peticiones
+    variantes = variantes or list(VARIANTES_BENCH)
+    tasa = PETICIONES_POR_SEGUNDO if tasa is None else tasa
+    limitador_original, cliente_original = limitador_peticiones, cliente_http
+    resultados = []
+    with ServidorReplay(grabacion, latencia, tasa_errores) as servidor:
+        metadatos = servidor.metadatos
+        targets = [{"casid": casid} for casid in metadatos.get("canales", [])] or None
+        desde = date.fromisoformat(metadatos["desde"]) if metadatos.get("desde") else None
+        dias = metadatos.get("dias", DIAS_A_PROCESAR)
+        for nombre in variantes:
+            ajustes = VARIANTES_BENCH[nombre]
+            originales = {clave: globals()[clave] for clave in ajustes}
+            globals().update(ajustes)
+            segundos, programas, etapas = [], 0, {}
+            try:
+                for _ in range(repeticiones):
+                    limitador_peticiones = LimitadorTasa(tasa or 1e9, RAFAGA_PETICIONES)
+                    cliente_http = ClienteHTTP()
+                    cliente_http.replay_base = servidor.url_base
+                    _indices_canales.clear()
+                    metricas.reiniciar()
+                    with tempfile.TemporaryDirectory() as directorio, contextlib.chdir(directorio), \
+                         contextlib.redirect_stdout(io.StringIO()), log_silenciado():
+                        inicio = time.perf_counter()
+                        generar_epg(targets, dias, GRID_WORKERS, SALIDA_GZIP, desde=desde, persistente=False)
+                        segundos.append(time.perf_counter() - inicio)
+                    programas = metricas.contadores.get("programas_escritos", 0)
+                    for etapa, e in metricas.etapas.items():
+                        etapas[etapa] = etapas.get(etapa, 0.0) + e["segundos"] / repeticiones
+            finally:
+                globals().update(originales)
+                limitador_peticiones, cliente_http = limitador_original, cliente_original
+            media = sum(segundos) / len(segundos)
+            resultados.append((nombre, programas, media, min(segundos), etapas))
+
+    print(f"{'Variante':<16} {'prog':>6} {'prog/s':>8} {'media s':>8} {'mín s':>8} " + " ".join(f"{etapa[:12]:>12}" for etapa in ETAPAS_BENCH))
+    for nombre, programas, media, minimo, etapas in resultados:
+        print(f"{nombre:<16} {programas:>6} {programas / media:>8.1f} {media:>8.2f} {minimo:>8.2f} "
+              + " ".join(f"{etapas.get(etapa, 0.0):>12.3f}" for etapa in ETAPAS_BENCH))
+    log.info(f"Etapas en segundos acumulados por ejecución (las que corren en varios hilos pueden sumar más que el total). "
+             f"{repeticiones} repeticiones, latencia {latencia * 1000:.0f} ms, {tasa_errores:.0%} errores, "
+             f"{'sin límite de' if not tasa else f'máx. {tasa:g}'} peticiones/s.")
+    return resultados
+
+
+# --- Consultas sobre la guía generada ---
+def instante_consulta(texto):
+    """Epoch de una fecha ISO (sin zona se entiende hora de LOCAL_TIMEZONE); None o "" es ahora."""
+    if not texto:
+        return int(time.time())
+    fecha = datetime.fromisoformat(texto)
+    if fecha.tzinfo is None:
+        fecha = LOCAL_TIMEZONE.localize(fecha)
+    return int(fecha.timestamp())
+
+def consultar_guia(ruta_xml, canal=None, en=None, hasta=None, titulo=None, limite=50):
+    """
+    Responde con IndiceGuia a la consulta de la línea de órdenes y la imprime en JSON:
+    búsqueda por `titulo`, programas entre `en` y `hasta`, o lo que se emite en `en` y a continuación.
+    """
+    indice = IndiceGuia.cargar(ruta_xml)
+    canales = [canal] if canal else indice.canales
+    if canal and canal not in indice.nombres and canal not in indice.canales:
+        log.error(f"El canal '{canal}' no está en la guía.")
+        return None
+    if titulo:
+        resultado = indice.buscar_titulo(titulo, canal, limite)
+    elif hasta:
+        desde = instante_consulta(en)
+        resultado = {c: indice.en_rango(c, desde, instante_consulta(hasta)) for c in canales}
+    else:
+        instante = instante_consulta(en)
+        resultado = {}
+        for c in canales:
+            actual, siguiente = indice.ahora_y_siguiente(c, instante)
+            resultado[c] = {"ahora": actual, "siguiente": siguiente}
+    print(json.dumps(resultado, ensure_ascii=False, indent=2))
+    return resultado
+
+
+# --- Fusión de guías XMLTV ---
+def leer_canales_xmltv(ruta):
+    """Los <channel> de un XMLTV. La DTD los pone antes que los programas, así que se deja de leer en el primero."""
+    canales = []
+    with abrir_xmltv(ruta) as f:
+        for _, elem in etree.iterparse(f, events=("end",), tag=("channel", "programme")):
+            if elem.tag == "programme":
+                break
+            canales.append(elem)
+    return canales
+
+def iterar_programas_xmltv(ruta, prioridad, ventana=VENTANA_FUSION):
+    """
+    Recorre los <programme> de un XMLTV con iterparse y produce ((canal, inicio UTC), prioridad, fin,
+    xml) ordenados por canal e inicio. Cada elemento se serializa y se libera nada más leerlo, así
+    que la memoria no depende del tamaño del fichero sino de `ventana`: los programas que se pueden
+    retener para reordenar una entrada casi ordenada. Si el desorden es mayor, ValueError.
+    """
+    en_ventana, anterior = [], None
+    def siguiente():
+        nonlocal anterior
+        clave, _, fin, xml, linea = heapq.heappop(en_ventana)
+        if anterior is not None and clave < anterior:
+            raise ValueError(f"'{ruta}' no está ordenado por canal e inicio (línea {linea}: '{clave[0]}' "
+                             f"{datetime.fromtimestamp(clave[1], timezone.utc):%Y-%m-%d %H:%M} UTC llega más de "
+                             f"{ventana} programas tarde)")
+        anterior = clave
+        return clave, prioridad, fin, xml
+    with abrir_xmltv(ruta) as f:
+        for n, (_, elem) in enumerate(etree.iterparse(f, events=("end",), tag="programme")):
+            inicio = instante_xmltv(elem.get("start"))
+            fin = instante_xmltv(elem.get("stop")) if elem.get("stop") else inicio
+            heapq.heappush(en_ventana, ((elem.get("channel") or "", inicio), n, fin,
+                                        etree.tostring(elem, encoding="unicode", with_tail=False), elem.sourceline))
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            if len(en_ventana) > ventana:
+                yield siguiente()
+    while en_ventana:
+        yield siguiente()
+
+def fusionar_xmltv(rutas, salida, ventana=VENTANA_FUSION):
+    """
+    Mezcla varias guías XMLTV en `salida` sin cargarlas en memoria: primero los <channel> de todas
+    y después los <programme>, con un merge de k vías (heapq) por canal e inicio; por eso cada
+    entrada tiene que venir ordenada así, salvo desórdenes de menos de `ventana` programas. El orden
+    de `rutas` es la prioridad: si un id de canal se repite vale la primera declaración, y si dos
+    programas de guías distintas se solapan en un canal, se queda el de la guía anterior.
+    Devuelve un resumen, o None si alguna entrada no sirve.
+    """
+    inicio = time.time()
+    canales, canales_repetidos = {}, 0
+    for ruta in rutas:
+        for elem in leer_canales_xmltv(ruta):
+            if elem.get("id") in canales:
+                canales_repetidos += 1
+            else:
+                canales[elem.get("id")] = etree.tostring(elem, encoding="unicode", with_tail=False)
+    leidos, descartados = [0] * len(rutas), 0
+    try:
+        with metricas.etapa("fusion"), EscritorXMLTV(salida, f"MultiPopUps fusión de {len(rutas)} guías") as escritor:
+            for xml in canales.values():
+                escritor.volcar(xml, programa=False)
+            # En caso de empate heapq.merge respeta el orden de las entradas, es decir, la prioridad
+            programas = heapq.merge(*(iterar_programas_xmltv(ruta, i, ventana) for i, ruta in enumerate(rutas)),
+                                    key=lambda p: p[0])
+            pendiente = None # (canal, fin, prioridad, xml): el último programa leído, que aún puede perder un solape
+            for (canal, inicio_programa), prioridad, fin, xml in programas:
+                leidos[prioridad] += 1
+                if pendiente is not None and pendiente[0] == canal and inicio_programa < pendiente[1] and prioridad != pendiente[2]:
+                    descartados += 1
+                    if prioridad > pendiente[2]:
+                        continue
+                    pendiente = None
+                if pendiente is not None:
+                    escritor.volcar(pendiente[3])
+                pendiente = (canal, fin, prioridad, xml)
+            if pendiente is not None:
+                escritor.volcar(pendiente[3])
+    except (OSError, ValueError, etree.XMLSyntaxError) as e:
+        log.error(f"No se pudo fusionar: {e}")
+        return None
+    for ruta, n in zip(rutas, leidos):
+        log.info(f"'{ruta}': {n} programas leídos.")
+    log.info(f"Fusión escrita en '{salida}': {escritor.canales} canales ({canales_repetidos} repetidos), "
+             f"{escritor.programas} programas ({descartados} descartados por solaparse) en {time.time() - inicio:.2f} s.")
+    return {"canales": escritor.canales, "canales_repetidos": canales_repetidos,
+            "programas": escritor.programas, "descartados": descartados}
+
+
+# --- Modo servidor ---
+@dataclass(slots=True, frozen=True)
+class InstantaneaGuia:
+    """
+    Una guía lista para servir: el XML en bruto y ya comprimido, su ETag y su índice de consulta.
+    No se modifica nunca; al refrescar se construye otra y se sustituye la referencia de una vez,
+    así que cada petición ve entera la guía anterior o la nueva.
+    """
+    xml: bytes
+    xml_gz: bytes
+    etag: str
+    generada: float # Fin de la última generación correcta (aunque el XML no cambiara)
+    indice: IndiceGuia
+    respuestas_json: dict # (canal o None) -> (válida hasta, cuerpo JSON); se rellena bajo demanda
+
+    @classmethod
+    def desde_fichero(cls, ruta_xml, generada=None):
+        """La guía de `ruta_xml`, generada en `generada` (epoch; por defecto, la fecha de modificación del fichero)."""
+        with open(ruta_xml, "rb") as f:
+            xml = f.read()
+        return cls(xml, gzip.compress(xml, compresslevel=9, mtime=0), '"' + hashlib.sha256(xml).hexdigest()[:32] + '"',
+                   generada or os.path.getmtime(ruta_xml), IndiceGuia.cargar(ruta_xml), {})
+
+class ServidorGuia:
+    """
+    Modo servir: mantiene la guía en memoria y la regenera en segundo plano cada `intervalo`
+    segundos con `generar` (una llamada a generar_epg, que devuelve el motivo si falla). Rutas:
+      /epg.xml      XMLTV (gzip si el cliente lo acepta), con ETag y 304
+      /epg.xml.gz   XMLTV comprimido
+      /ahora.json   lo que se emite ahora y a continuación en cada canal
+      /ahora/<canal>.json  lo mismo para un canal
+      /salud        estado del servidor
+    El XML se sirve desde buffers precalculados en cada refresco; el JSON de ahora/siguiente se
+    guarda hasta que cambia el programa en emisión.
+    """
+    def __init__(self, generar, host=SERVIR_HOST, puerto=SERVIR_PUERTO, intervalo=SERVIR_INTERVALO_MINUTOS * 60):
+        self.generar = generar
+        self.intervalo = intervalo
+        self.instantanea = None
+        self.ultimo_error = None
+        self._parar = threading.Event()
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            def do_GET(self):
+                servidor._responder(self, cuerpo=True)
+            def do_HEAD(self):
+                servidor._responder(self, cuerpo=False)
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, puerto), Manejador)
+        self.httpd.daemon_threads = True
+
+    def refrescar(self):
+        """Regenera la guía y publica la nueva instantánea; si falla se sigue sirviendo la anterior."""
+        try:
+            _indices_canales.clear() # El CSV de canales también puede haber cambiado
+            metricas.reiniciar()
+            cliente_http.reiniciar_estadisticas()
+            error = self.generar()
+            if error:
+                raise RuntimeError(error)
+            # Si la guía no ha cambiado el fichero conserva su fecha: la de la instantánea es la de ahora
+            self.instantanea = InstantaneaGuia.desde_fichero(OUTPUT_XML_FILE, generada=time.time())
+            self.ultimo_error = None
+            log.info(f"Guía publicada: {len(self.instantanea.xml) / 1024:.0f} KiB, {len(self.instantanea.xml_gz) / 1024:.0f} KiB comprimida.")
+        except Exception as e:
+            self.ultimo_error = f"{e!r}"
+            log.error(f"No se pudo refrescar la guía (se mantiene la anterior): {e}")
+
+    def _bucle_refresco(self):
+        self.refrescar()
+        while not self._parar.wait(self.intervalo):
+            self.refrescar()
+
+    def _json_ahora(self, instantanea, canal):
+        ahora = int(time.time())
+        guardada = instantanea.respuestas_json.get(canal)
+        if guardada is not None and (guardada[0] is None or ahora < guardada[0]):
+            return guardada[1], guardada[0]
+        indice = instantanea.indice
+        canales = [canal] if canal is not None else indice.canales
+        resultado, cambios = {}, []
+        for c in canales:
+            actual, siguiente = indice.ahora_y_siguiente(c, ahora)
+            resultado[c] = {"ahora": actual, "siguiente": siguiente}
+            cambio = indice.proximo_cambio(c, ahora)
+            if cambio is not None:
+                cambios.append(cambio)
+        valida_hasta = min(cambios) if cambios else None
+        cuerpo = json.dumps(resultado if canal is None else resultado[canal], ensure_ascii=False).encode("utf-8")
+        instantanea.respuestas_json[canal] = (valida_hasta, cuerpo)
+        return cuerpo, valida_hasta
+
+    def _responder(self, peticion, cuerpo=True):
+        ruta = urlsplit(peticion.path).path
+        instantanea = self.instantanea # Una sola lectura: toda la respuesta sale de la misma guía
+        cabeceras = {}
+        if ruta == "/salud":
+            estado, tipo = 200, "application/json"
+            datos = json.dumps({"lista": instantanea is not None, "ultimo_error": self.ultimo_error,
+                                "generada": datetime.fromtimestamp(instantanea.generada, LOCAL_TIMEZONE).isoformat() if instantanea else None}).encode("utf-8")
+        elif instantanea is None:
+            estado, tipo, datos = 503, "text/plain; charset=utf-8", "Guía aún no disponible\n".encode("utf-8")
+            cabeceras["Retry-After"] = "30"
+        elif ruta in ("/epg.xml", "/epg.xml.gz"):
+            cabeceras["ETag"] = instantanea.etag
+            cabeceras["Cache-Control"] = "no-cache"
+            comprimido = ruta.endswith(".gz") or "gzip" in peticion.headers.get("Accept-Encoding", "")
+            if ruta == "/epg.xml":
+                cabeceras["Vary"] = "Accept-Encoding"
+                if comprimido:
+                    cabeceras["Content-Encoding"] = "gzip"
+            tipo = "application/gzip" if ruta.endswith(".gz") else "application/xml; charset=utf-8"
+            if instantanea.etag in [e.strip() for e in peticion.headers.get("If-None-Match", "").split(",")]:
+                estado, datos = 304, None
+            else:
+                estado, datos = 200, instantanea.xml_gz if comprimido else instantanea.xml
+        elif ruta == "/ahora.json" or (ruta.startswith("/ahora/") and ruta.endswith(".json")):
+            canal = unquote(ruta[len("/ahora/"):-len(".json")]) if ruta.startswith("/ahora/") else None
+            if canal is not None and canal not in instantanea.indice.canales:
+                estado, tipo, datos = 404, "application/json", b'{"error": "canal desconocido"}'
+            else:
+                datos, valida_hasta = self._json_ahora(instantanea, canal)
+                estado, tipo = 200, "application/json"
+                if valida_hasta is not None:
+                    cabeceras["Cache-Control"] = f"max-age={max(valida_hasta - int(time.time()), 0)}"
+        else:
+            estado, tipo, datos = 404, "text/plain; charset=utf-8", b"No encontrado\n"
+
+        peticion.send_response(estado)
+        peticion.send_header("Content-Type", tipo)
+        for nombre, valor in cabeceras.items():
+            peticion.send_header(nombre, valor)
+        if datos is not None:
+            peticion.send_header("Content-Length", str(len(datos)))
+        peticion.end_headers()
+        if cuerpo and datos is not None:
+            peticion.wfile.write(datos)
+
+    def servir(self):
+        """Publica la guía que ya haya en disco, arranca el refresco periódico y atiende peticiones hasta Ctrl+C."""
+        if os.path.exists(OUTPUT_XML_FILE):
+            try:
+                self.instantanea = InstantaneaGuia.desde_fichero(OUTPUT_XML_FILE)
+                log.info(f"Publicada la guía existente '{OUTPUT_XML_FILE}' mientras se genera la nueva.")
+            except Exception as e:
+                log.warning(f"No se pudo cargar la guía existente: {e}")
+        threading.Thread(target=self._bucle_refresco, daemon=True).start()
+        host, puerto = self.httpd.server_address[:2]
+        log.info(f"Sirviendo la guía en http://{host}:{puerto}/epg.xml (refresco cada {self.intervalo / 60:g} min).")
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._parar.set()
+            self.httpd.server_close()
+
+
+def main(argv=None):
+    global IMAGENES_URL_BASE, MINIATURAS_ANCHOS, PARSEO_PROCESOS
+    parser = argparse.ArgumentParser(description="Genera la guía EPG (XMLTV) con descripciones completas de Movistar Plus.")
+    parser.add_argument("--nivel-log", default=NIVEL_LOG, type=str.upper, choices=["DEBUG", "INFO", "ADVERTENCIA", "ERROR"],
+                        help=f"Mensajes a partir de este nivel (por defecto {NIVEL_LOG}).")
+    subparsers = parser.add_subparsers(dest="comando")
+    p_generar = subparsers.add_parser("generar", help="Genera el XML (comando por defecto).")
+    grupo_canales = p_generar.add_mutually_exclusive_group()
+    grupo_canales.add_argument("--canales", help="CasIds (o CodCadenaTv / Nombre) separados por comas (por defecto TARGET_CHANNELS).")
+    grupo_canales.add_argument("--canales-file", help="Fichero con los canales: .json (lista) o texto con un CasId por línea.")
+    p_generar.add_argument("--dias", type=int, help=f"Días a procesar (por defecto {DIAS_A_PROCESAR}, o los de la grabación con --replay).")
+    p_generar.add_argument("--desde", type=date.fromisoformat, help="Primer día a procesar, AAAA-MM-DD (por defecto hoy, o el de la grabación con --replay).")
+    p_generar.add_argument("--grid-workers", type=int, default=GRID_WORKERS, help=f"Hilos para las parrillas (por defecto {GRID_WORKERS}).")
+    p_generar.add_argument("--procesos", type=int, default=PARSEO_PROCESOS,
+                           help=f"Procesos que extraen fichas y parrillas (0: en los hilos de descarga; por defecto {PARSEO_PROCESOS}).")
+    p_generar.add_argument("--gzip", action="store_true", default=SALIDA_GZIP, help=f"Escribe también {OUTPUT_XML_FILE}.gz.")
+    p_generar.add_argument("--presupuesto", "--time-budget", type=float, default=PRESUPUESTO_SEGUNDOS, metavar="SEGUNDOS",
+                           help="Tiempo máximo: las fichas se piden por orden de emisión y al agotarse se escribe la guía con lo obtenido.")
+    p_generar.add_argument("--imagenes", action="store_true", default=IMAGENES,
+                           help=f"Descarga las carátulas a {IMAGENES_DIR}/, genera miniaturas y apunta los <icon> a ellas.")
+    p_generar.add_argument("--imagenes-url-base", default=IMAGENES_URL_BASE,
+                           help=f"Con --imagenes: prefijo de los <icon src> (ruta o URL de la CDN; por defecto {IMAGENES_URL_BASE}).")
+    p_generar.add_argument("--miniaturas", default=",".join(map(str, MINIATURAS_ANCHOS)), metavar="ANCHOS",
+                           help="Con --imagenes: anchos en px separados por comas; los <icon> usan el primero.")
+    p_generar.add_argument("--delta", default=DELTA_FILE, metavar="FICHERO",
+                           help="Escribe en FICHERO (JSON) las franjas de canal y día que han cambiado respecto a la guía anterior.")
+    p_generar.add_argument("--informe", default=INFORME_FILE, help="Escribe las métricas de la ejecución en este fichero (.json o .prom).")
+    grupo_red = p_generar.add_mutually_exclusive_group()
+    grupo_red.add_argument("--grabar", metavar="DIR", help="Guarda en DIR todas las respuestas descargadas (sin usar cachés).")
+    grupo_red.add_argument("--replay", metavar="DIR", help="Sirve las respuestas de una grabación desde un servidor local en vez de usar la red.")
+    p_generar.add_argument("--latencia", type=float, default=0.0, help="Con --replay: milisegundos añadidos a cada respuesta.")
+    p_generar.add_argument("--errores", type=float, default=0.0, help="Con --replay: proporción (0-1) de respuestas 503.")
+    p_servir = subparsers.add_parser("servir", help="Sirve la guía por HTTP y la regenera periódicamente en segundo plano.")
+    grupo_canales_servir = p_servir.add_mutually_exclusive_group()
+    grupo_canales_servir.add_argument("--canales", help="CasIds (o CodCadenaTv / Nombre) separados por comas (por defecto TARGET_CHANNELS).")
+    grupo_canales_servir.add_argument("--canales-file", help="Fichero con los canales: .json (lista) o texto con un CasId por línea.")
+    p_servir.add_argument("--dias", type=int, default=DIAS_A_PROCESAR, help=f"Días a procesar desde hoy (por defecto {DIAS_A_PROCESAR}).")
+    p_servir.add_argument("--host", default=SERVIR_HOST, help=f"Dirección de escucha (por defecto {SERVIR_HOST}).")
+    p_servir.add_argument("--puerto", type=int, default=SERVIR_PUERTO, help=f"Puerto (por defecto {SERVIR_PUERTO}).")
+    p_servir.add_argument("--intervalo", type=float, default=SERVIR_INTERVALO_MINUTOS, help=f"Minutos entre regeneraciones (por defecto {SERVIR_INTERVALO_MINUTOS}).")
+    p_consulta = subparsers.add_parser("consulta", help="Consulta la guía generada: ahora/siguiente, intervalo o título (salida JSON).")
+    p_consulta.add_argument("--xml", default=OUTPUT_XML_FILE, help=f"Guía a consultar (por defecto {OUTPUT_XML_FILE}; se usa su índice .idx.sqlite si existe).")
+    p_consulta.add_argument("--canal", help="Id del canal (por defecto todos).")
+    p_consulta.add_argument("--en", help="Instante ISO (AAAA-MM-DDTHH:MM, hora local si no lleva zona); por defecto ahora.")
+    p_consulta.add_argument("--hasta", help="Con --hasta se listan los programas entre --en y --hasta.")
+    p_consulta.add_argument("--titulo", help="Busca programas cuyo título empieza por este texto.")
+    p_consulta.add_argument("--limite", type=int, default=50, help="Máximo de resultados de --titulo (por defecto 50).")
+    p_fusionar = subparsers.add_parser("fusionar", help="Mezcla varias guías XMLTV en streaming, con memoria constante.")
+    p_fusionar.add_argument("entradas", nargs="+", help="Guías (.xml o .xml.gz) ordenadas por canal e inicio; en los solapes gana la primera.")
+    p_fusionar.add_argument("-o", "--salida", required=True, help="Fichero resultante (.xml o .xml.gz).")
+    p_fusionar.add_argument("--ventana", type=int, default=VENTANA_FUSION,
+                            help=f"Programas por guía que se pueden reordenar si no viene del todo ordenada (por defecto {VENTANA_FUSION}).")
+    p_bench_e2e = subparsers.add_parser("bench", help="Mide programas/s y tiempos por etapa contra una grabación (--grabar).")
+    p_bench_e2e.add_argument("grabacion", help="Directorio de una grabación hecha con generar --grabar.")
+    p_bench_e2e.add_argument("--variantes", help=f"Variantes separadas por comas (por defecto todas: {', '.join(VARIANTES_BENCH)}).")
+    p_bench_e2e.add_argument("--repeticiones", type=int, default=3, help="Ejecuciones por variante (por defecto 3).")
+    p_bench_e2e.add_argument("--latencia", type=float, default=0.0, help="Milisegundos añadidos a cada respuesta.")
+    p_bench_e2e.add_argument("--errores", type=float, default=0.0, help="Proporción (0-1) de respuestas 503.")
+    p_bench_e2e.add_argument("--tasa", type=float, help=f"Peticiones/s de fichas (por defecto {PETICIONES_POR_SEGUNDO:g}; 0 = sin límite).")
+    p_bench_modelo = subparsers.add_parser("bench-modelo", help="Compara memoria y composición de la <desc> del modelo frente a diccionarios.")
+    p_bench_modelo.add_argument("--programas", type=int, default=50000, help="Emisiones sintéticas (por defecto 50000).")
+    p_bench_modelo.add_argument("--fichas", type=int, default=5000, help="Fichas distintas (por defecto 5000).")
+    p_bench = subparsers.add_parser("bench-parseo", help="Compara los motores de extracción bs4 y lxml sobre HTML guardado.")
+    p_bench.add_argument("rutas", nargs="*", help="Ficheros .html, directorios que los contengan o grabaciones de generar --grabar (por defecto las páginas de tests/fixtures/html).")
+    p_bench.add_argument("--repeticiones", type=int, default=5, help="Veces que se parsea cada página (por defecto 5).")
+    p_bench.add_argument("--procesos", type=int, default=0, help="Mide también la extracción en paralelo con hasta N procesos.")
+    p_bench.add_argument("--paginas", type=int, default=2000, help="Con --procesos: páginas que se extraen en cada medida (por defecto 2000).")
+    args = parser.parse_args(argv)
+    configurar_log(args.nivel_log)
+
+    error = None # Motivo del fallo de generar_epg: el proceso termina con código 1
+    if args.comando == "bench-parseo":
+        benchmark_parseo(args.rutas, args.repeticiones, args.procesos, args.paginas)
+    elif args.comando == "servir":
+        targets = None
+        if args.canales:
+            targets = [{"casid": c.strip()} for c in args.canales.split(",") if c.strip()]
+        elif args.canales_file:
+            targets = cargar_canales(args.canales_file)
+        ServidorGuia(lambda: generar_epg(targets, args.dias), args.host, args.puerto, args.intervalo * 60).servir()
+    elif args.comando == "consulta":
+        consultar_guia(args.xml, args.canal, args.en, args.hasta, args.titulo, args.limite)
+    elif args.comando == "fusionar":
+        fusionar_xmltv(args.entradas, args.salida, args.ventana)
+    elif args.comando == "bench-modelo":
+        benchmark_modelo(args.programas, args.fichas)
+    elif args.comando == "bench":
+        variantes = [v.strip() for v in args.variantes.split(",")] if args.variantes else None
+        desconocidas = [v for v in variantes or [] if v not in VARIANTES_BENCH]
+        if desconocidas:
+            parser.error(f"variantes desconocidas: {', '.join(desconocidas)}")
+        benchmark(args.grabacion, variantes, args.repeticiones, args.latencia / 1000, args.errores, args.tasa)
+    elif args.comando == "generar":
+        try:
+            MINIATURAS_ANCHOS = tuple(int(a) for a in args.miniaturas.split(",") if a.strip())
+        except ValueError:
+            parser.error(f"--miniaturas: anchos no válidos: {args.miniaturas}")
+        IMAGENES_URL_BASE = args.imagenes_url_base
+        PARSEO_PROCESOS = args.procesos
+        targets = None
+        if args.canales:
+            targets = [{"casid": c.strip()} for c in args.canales.split(",") if c.strip()]
+        elif args.canales_file:
+            targets = cargar_canales(args.canales_file)
+        if args.replay:
+            with ServidorReplay(args.replay, args.latencia / 1000, args.errores) as servidor:
+                cliente_http.replay_base = servidor.url_base
+                metadatos = servidor.metadatos
+                targets = targets or [{"casid": casid} for casid in metadatos.get("canales", [])] or None
+                desde = args.desde or (date.fromisoformat(metadatos["desde"]) if metadatos.get("desde") else None)
+                error = generar_epg(targets, args.dias or metadatos.get("dias", DIAS_A_PROCESAR), args.grid_workers, args.gzip,
+                                    args.informe, desde=desde, persistente=False, presupuesto=args.presupuesto,
+                                    imagenes=args.imagenes, delta=args.delta)
+        else:
+            error = generar_epg(targets, args.dias or DIAS_A_PROCESAR, args.grid_workers, args.gzip, args.informe,
+                                desde=args.desde, grabar=args.grabar, presupuesto=args.presupuesto, imagenes=args.imagenes,
+                                delta=args.delta)
+    else:
+        error = generar_epg()
+    if error:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import importlib.util
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+RAIZ = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def epg():
+    """epg-popups.py cargado como módulo (el guion no se puede importar por su nombre)."""
+    spec = importlib.util.spec_from_file_location("epg_popups", RAIZ / "epg-popups.py")
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def cuerpo_csv():
+    filas = ["CasId,Nombre,Logo,CodCadenaTv"]
+    filas += [f"{5000 + i},Canal {i},http://logo/{i}.png,COD{i}" for i in range(4)]
+    return ("﻿" + "\n".join(filas) + "\n").encode("utf-8")
+
+
+def cuerpo_parrilla(puerto, cod, fecha):
+    bloques = []
+    for hora in range(0, 24, 3):
+        ficha = (sum(map(ord, cod + fecha)) + hora) % 20
+        bloques.append(f'<div class="container_box g_CN"><a href="http://127.0.0.1:{puerto}/ficha/{ficha}">x</a>'
+                       f'<ul><li class="title">Peli {ficha}</li><li class="time">{hora:02d}:{ficha:02d}</li></ul></div>')
+    return f"<html><body>{''.join(bloques)}</body></html>".encode("utf-8")
+
+
+def cuerpo_ficha(ficha):
+    ld = {"@type": "Movie", "director": [{"name": f"Dir {ficha}"}], "actor": [{"name": "A"}, {"name": "B"}]}
+    return f'''<!DOCTYPE html><html><head><meta charset="utf-8">
+<meta property="og:title" content="Ver Peli {ficha} ({1980 + ficha}) | Movistar Plus">
+<meta name="description" content="Peli {ficha} - Sinopsis de la peli {ficha}.">
+<script type="application/ld+json">{json.dumps(ld)}</script>
+</head><body><ul class="list-info-movie"><li>a</li></ul><span>n</span><p>Comedia</p><p>España ({1980 + ficha})</p>
+</body></html>'''.encode("utf-8")
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latencia)
+        ruta = self.path.split("?")[0]
+        if ruta == "/csv":
+            cuerpo = cuerpo_csv()
+        elif ruta.startswith("/programacion-tv/"):
+            _, _, cod, fecha = ruta.split("/")
+            cuerpo = cuerpo_parrilla(self.server.server_port, cod, fecha)
+        elif ruta.startswith("/ficha/"):
+            cuerpo = cuerpo_ficha(int(ruta.rsplit("/", 1)[1]))
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with self.server.cerrojo:
+            self.server.peticiones += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+
+class ServidorFalso(ThreadingHTTPServer):
+    """Imitación local de difusion.csv y movistarplus.es con `latencia` segundos por respuesta."""
+    daemon_threads = True
+
+    def __init__(self, latencia):
+        super().__init__(("127.0.0.1", 0), _Manejador)
+        self.latencia = latencia
+        self.peticiones = 0
+        self.cerrojo = threading.Lock()
+
+    @property
+    def url_base(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+@pytest.fixture
+def servidor_falso():
+    servidor = ServidorFalso(latencia=0.03)
+    hilo = threading.Thread(target=servidor.serve_forever, daemon=True)
+    hilo.start()
+    yield servidor
+    servidor.shutdown()
+    servidor.server_close()
+
+
+@pytest.fixture
+def epg_local(epg, servidor_falso, monkeypatch, tmp_path):
+    """El módulo apuntando al servidor falso, sin cachés persistentes y escribiendo en `tmp_path`."""
+    monkeypatch.setattr(epg, "CSV_URL", f"{servidor_falso.url_base}/csv")
+    monkeypatch.setattr(epg, "BASE_PROGRAM_URL", f"{servidor_falso.url_base}/programacion-tv/")
+    monkeypatch.setattr(epg, "INDICE_GUIA", False)
+    monkeypatch.setattr(epg, "limitador_peticiones", epg.LimitadorTasa(1e9, epg.RAFAGA_PETICIONES))
+    monkeypatch.setattr(epg, "cliente_http", epg.ClienteHTTP())
+    monkeypatch.chdir(tmp_path)
+    epg._indices_canales.clear()
+    epg.metricas.reiniciar()
+    return epg
@@ -0,0 +1,28 @@
+import time
+from datetime import date
+
+CANALES = [{"casid": str(5000 + i)} for i in range(4)]
+DESDE = date(2024, 1, 1)
+
+
+def _generar(epg, monkeypatch, hilos):
+    """Una ejecución completa con `hilos` para parrillas y fichas; devuelve (segundos, guía sin cabecera)."""
+    monkeypatch.setattr(epg, "DETALLES_WORKERS", hilos)
+    monkeypatch.setattr(epg, "cliente_http", epg.ClienteHTTP())
+    epg._indices_canales.clear()
+    inicio = time.perf_counter()
+    epg.generar_epg(CANALES, 2, hilos, False, None, desde=DESDE, persistente=False)
+    segundos = time.perf_counter() - inicio
+    with open(epg.OUTPUT_XML_FILE, encoding="utf-8") as f:
+        return segundos, f.read().split("\n", 2)[2]
+
+
+def test_fichas_en_paralelo_mas_rapido_y_misma_guia(epg_local, monkeypatch, servidor_falso):
+    secuencial, guia_secuencial = _generar(epg_local, monkeypatch, 1)
+    peticiones = servidor_falso.peticiones
+    paralelo, guia_paralela = _generar(epg_local, monkeypatch, 8)
+
+    assert "<programme" in guia_secuencial
+    assert guia_paralela == guia_secuencial
+    assert servidor_falso.peticiones == 2 * peticiones
+    assert paralelo < secuencial / 2
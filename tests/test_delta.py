@@ -0,0 +1,33 @@
+import json
+import os
+from datetime import date
+
+CANALES = [{"casid": "5000"}, {"casid": "5001"}]
+DESDE = date(2024, 1, 1)
+
+
+def _generar(epg):
+    epg._indices_canales.clear()
+    epg.generar_epg(CANALES, 1, 2, False, None, desde=DESDE, persistente=False, delta="delta.json")
+
+
+def test_delta_se_conserva_si_la_guia_no_cambia(epg_local, monkeypatch):
+    _generar(epg_local)
+    with open("delta.json", encoding="utf-8") as f:
+        primero = json.load(f)
+    assert {franja["cambio"] for franja in primero["franjas"]} == {"nueva"}
+    os.utime("delta.json", (0, 0))
+
+    monkeypatch.setattr(epg_local, "cliente_http", epg_local.ClienteHTTP())
+    _generar(epg_local)
+    assert os.stat("delta.json").st_mtime == 0
+    with open("delta.json", encoding="utf-8") as f:
+        assert json.load(f) == primero
+
+
+def test_fallo_al_escribir_el_delta_se_devuelve(epg_local):
+    os.mkdir("delta.json") # os.replace no puede sustituir un directorio por el fichero
+    epg_local._indices_canales.clear()
+    with epg_local.log_silenciado():
+        error = epg_local.generar_epg(CANALES, 1, 2, False, None, desde=DESDE, persistente=False, delta="delta.json")
+    assert error and "delta.json" in error
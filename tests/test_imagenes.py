@@ -0,0 +1,38 @@
+import io
+from types import SimpleNamespace
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+
+class ClienteImagenes:
+    """Sirve la misma imagen para cualquier URL."""
+
+    def __init__(self):
+        salida = io.BytesIO()
+        Image.new("RGB", (400, 600), "red").save(salida, "PNG")
+        self.contenido = salida.getvalue()
+
+    def get(self, url, **kwargs):
+        return SimpleNamespace(content=self.contenido, raise_for_status=lambda: None)
+
+
+def _preparar(epg, directorio, urls):
+    almacen = epg.AlmacenImagenes(str(directorio), "iconos/", (180,))
+    srcs = [futuro.result() for futuro in [almacen.solicitar(url) for url in urls]]
+    almacen.cerrar()
+    return almacen, srcs
+
+
+def test_misma_imagen_se_cuenta_una_vez_por_url_repetida(epg, monkeypatch, tmp_path):
+    monkeypatch.setattr(epg, "cliente_http", ClienteImagenes())
+
+    almacen, srcs = _preparar(epg, tmp_path, ["http://img/a.png", "http://img/b.png", "http://img/c.png"])
+    assert len(set(srcs)) == 1
+    assert (almacen.descargadas, almacen.repetidas) == (3, 2)
+
+    # En otra ejecución, una URL nueva con la misma imagen reutiliza la guardada
+    almacen, srcs_nuevos = _preparar(epg, tmp_path, ["http://img/d.png", "http://img/a.png"])
+    assert srcs_nuevos == srcs[:1] * 2
+    assert (almacen.descargadas, almacen.en_cache, almacen.repetidas) == (1, 1, 1)
@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+from conftest import RAIZ
+
+PAGINAS = sorted((RAIZ / "tests" / "fixtures" / "html").glob("*.html"))
+
+
+def _extraer(epg, texto, motor):
+    if "container_box" in texto:
+        return epg.extraer_parrilla(texto, motor)
+    details = dict.fromkeys(epg.DETALLE_FIELDS)
+    epg.extraer_detalles(texto, details, motor)
+    return details
+
+
+@pytest.mark.parametrize("pagina", PAGINAS, ids=lambda p: p.stem)
+def test_motores_extraen_lo_mismo(epg, pagina):
+    texto = pagina.read_text(encoding="utf-8")
+    with epg.log_silenciado():
+        assert _extraer(epg, texto, "lxml") == _extraer(epg, texto, "bs4")
+
+
+def test_bench_parseo_usa_las_paginas_de_ejemplo(epg):
+    assert os.path.samefile(epg.PAGINAS_BENCH_PARSEO, RAIZ / "tests" / "fixtures" / "html")
+    assert any(p.stem.startswith("parrilla") for p in PAGINAS)
+    assert any(p.stem.startswith("ficha") for p in PAGINAS)
@@ -0,0 +1,65 @@
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+
+class CoalescedorLento:
+    """
+    Resuelve cada ficha en un hilo aparte tras `latencia` segundos; las de `en_cache`, casi enseguida
+    (pero también en otro hilo, como hace CoalescedorDetalles con las que sirve la caché).
+    """
+
+    def __init__(self, latencia, en_cache=()):
+        self.latencia = latencia
+        self.en_cache = set(en_cache)
+        self.desde_cache = set()
+        self.pedidas = 0
+
+    def solicitar(self, url):
+        self.pedidas += 1
+        futuro = Future()
+        if url in self.en_cache:
+            self.desde_cache.add(url)
+        temporizador = threading.Timer(0.02 if url in self.en_cache else self.latencia, futuro.set_result, [{"url": url}])
+        temporizador.daemon = True
+        temporizador.start()
+        return futuro
+
+
+def _programas(n):
+    return [SimpleNamespace(inicio=f"2030010100{i:02d}00 +0000", fin=f"2030010100{i + 1:02d}00 +0000",
+                            detail_url=f"http://fichas/{i}") for i in range(n)]
+
+
+def test_presupuesto_corto_obtiene_fichas(epg):
+    coalescedor = CoalescedorLento(0.1)
+    inicio = time.time()
+    with epg.log_silenciado():
+        detalles = epg.descargar_fichas_priorizadas(_programas(40), coalescedor, inicio + 1.5, en_vuelo_max=8)
+
+    assert len(detalles) >= 40 // 2
+    assert time.time() - inicio < 1.5 + 0.2
+
+
+def test_no_lanza_lo_que_no_llega_a_tiempo(epg):
+    coalescedor = CoalescedorLento(0.4)
+    inicio = time.time()
+    with epg.log_silenciado():
+        detalles = epg.descargar_fichas_priorizadas(_programas(40), coalescedor, inicio + 1.0, en_vuelo_max=2)
+
+    # Tras medir 0,4 s por ficha, las de la tanda que no cabría antes del plazo no se piden
+    assert len(detalles) == 4
+    assert coalescedor.pedidas == 4
+
+
+def test_las_fichas_de_la_cache_no_rebajan_la_latencia(epg):
+    urls = [f"http://fichas/{i}" for i in (1, 2)]
+    coalescedor = CoalescedorLento(0.4, en_cache=urls)
+    inicio = time.time()
+    with epg.log_silenciado():
+        detalles = epg.descargar_fichas_priorizadas(_programas(40), coalescedor, inicio + 1.15, en_vuelo_max=1)
+
+    # 0 y 3 se descargan (0,4 s cada una); si contaran las dos de la caché, la media bajaría y se lanzaría otra más
+    assert len(detalles) == 4
+    assert coalescedor.pedidas == 4
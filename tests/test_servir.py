@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+import time
+import urllib.request
+from datetime import date, datetime
+
+GUIA = '''<?xml version="1.0" encoding="UTF-8"?>
+<tv generator-info-name="prueba">
+  <channel id="C1"><display-name>C1</display-name></channel>
+  <programme start="20300101060000 +0000" stop="20300101070000 +0000" channel="C1"><title>P</title></programme>
+</tv>
+'''
+
+
+def _salud(servidor):
+    with urllib.request.urlopen(f"http://127.0.0.1:{servidor.httpd.server_port}/salud") as respuesta:
+        return json.load(respuesta)
+
+
+def test_generar_epg_devuelve_el_fallo_de_escritura(epg_local, monkeypatch):
+    monkeypatch.setattr(epg_local, "OUTPUT_XML_FILE", "no-existe/popups.xml")
+    with epg_local.log_silenciado():
+        error = epg_local.generar_epg([{"casid": "5000"}], 1, 1, False, None, desde=date(2024, 1, 1), persistente=False)
+    assert error and "no-existe/popups.xml" in error
+
+
+def test_refresco_fallido_mantiene_la_guia_y_publica_el_error(epg, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    resultados = iter([None, "No se pudo escribir el archivo XML: disco lleno"])
+
+    def generar():
+        with open(epg.OUTPUT_XML_FILE, "w", encoding="utf-8") as f:
+            f.write(GUIA)
+        return next(resultados)
+
+    servidor = epg.ServidorGuia(generar, "127.0.0.1", 0)
+    threading.Thread(target=servidor.httpd.serve_forever, daemon=True).start()
+    try:
+        with epg.log_silenciado():
+            servidor.refrescar()
+            publicada = servidor.instantanea
+            assert _salud(servidor)["ultimo_error"] is None
+
+            servidor.refrescar()
+        assert servidor.instantanea is publicada
+        salud = _salud(servidor)
+        assert salud["lista"] is True
+        assert "disco lleno" in salud["ultimo_error"]
+    finally:
+        servidor.httpd.shutdown()
+        servidor.httpd.server_close()
+
+
+def test_salud_informa_del_ultimo_refresco_aunque_la_guia_no_cambie(epg, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    with open(epg.OUTPUT_XML_FILE, "w", encoding="utf-8") as f:
+        f.write(GUIA)
+    os.utime(epg.OUTPUT_XML_FILE, (0, 0)) # El escritor no toca el fichero si el contenido es el mismo
+
+    servidor = epg.ServidorGuia(lambda: None, "127.0.0.1", 0)
+    threading.Thread(target=servidor.httpd.serve_forever, daemon=True).start()
+    try:
+        antes = time.time()
+        with epg.log_silenciado():
+            servidor.refrescar()
+        generada = datetime.fromisoformat(_salud(servidor)["generada"]).timestamp()
+        assert generada >= antes - 1
+    finally:
+        servidor.httpd.shutdown()
+        servidor.httpd.server_close()